@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+# Load requirements
+import numpy as np
+from datetime import datetime, timedelta
+import sys
+import os
+import json
+import time
+import argparse
+import tempfile
+import platform
+import threading
+import tracemalloc
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import targets
+import projects
+
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5]  # Default numbers of time entries; up to 10 ** 7 can be given
+WORKSPACE_ID = 1  # Workspace of the synthetic projects
+BATCH_SIZE = 10000  # Time entries written to the response at once
+
+
+class SyntheticData:
+    """
+    Random Toggl time entries for a year, held as numpy arrays so millions of them can be served.
+    The year starts 26 weeks before now, so the current week is in the middle of the second semester.
+    """
+
+    def __init__(self, n_entries, n_projects=10, n_tags=5, n_running=1, seed=0):
+        """
+        :param n_entries: number of time entries, including running timers
+        :param n_projects: number of tracked projects
+        :param n_tags: number of tags; each entry has up to 3
+        :param n_running: number of running timers (at the end of the entries)
+        :param seed: seed for the random numbers
+        """
+        random = np.random.default_rng(seed)
+        now = int(time.time())
+        self.start_date = datetime.fromtimestamp(now) - timedelta(weeks=26)
+        first = int(self.start_date.replace(hour=12).timestamp())
+
+        self.pids = np.arange(n_projects) + 1000  # Toggl project ids
+        self.tags = np.array(['tag{}'.format(n) for n in range(n_tags)])
+        n_stopped = max(n_entries - n_running, 0)
+        self.start = np.sort(random.integers(first, now - 4 * 60 * 60, n_stopped))
+        self.duration = random.integers(60, 3 * 60 * 60, n_stopped)
+        self.start = np.append(self.start, now - random.integers(60, 60 * 60, n_entries - n_stopped))
+        self.pid = self.pids[random.integers(0, n_projects, n_entries)] if n_projects > 0 else \
+            np.zeros(n_entries, dtype=int)
+        self.tag_sets = random.integers(0, 2 ** min(n_tags, 3), n_entries)  # Bit n set for tag n
+        self.n_stopped = n_stopped
+        self.stop = self.start + np.append(self.duration, np.zeros(n_entries - n_stopped, dtype=int))  # Running: start
+
+    def __len__(self):
+        return len(self.start)
+
+    def config_csv(self, path):
+        """
+        Write a config.csv for the synthetic projects and tags: two semesters of 26 weeks.
+        :param path: file to write
+        :return: nothing
+        """
+        n_rows = max(52, len(self.pids), len(self.tags), 3)
+        rows = [[''] * 11 for n in range(n_rows)]
+        rows[0][0], rows[1][0], rows[2][0] = 'benchmark', 'REFRESH_RATE', '60'
+        for week in range(52):
+            rows[week][2] = 'Week {}'.format(week + 1)
+            rows[week][4] = '1'
+        rows[0][1], rows[26][1] = 'Semester 1', 'Semester 2'
+        rows[0][3] = self.start_date.strftime('%Y-%m-%d')
+        for n, pid in enumerate(self.pids):
+            semester = ('Semester 1', 'Semester 2', 'ALL')[n % 3]
+            rows[n][5:9] = ['Project {}'.format(n), str(pid), semester, '100']
+        for n, tag in enumerate(self.tags):
+            rows[n][9:11] = [tag, tag[:6]]
+        with open(path, 'w') as f:
+            f.write('API_TOKEN,SEMESTER NAME,WEEK NAME,START_DATE,WORKLOAD,PROJECT _NAME,PID,SEMESTER,TOTAL_HOURS,'
+                    'TRACKED_TAGS,TAG_SYMBOL\n')
+            f.writelines(','.join(row) + '\n' for row in rows)
+
+    def entry(self, n, start, stop):
+        """
+        Make the Toggl API dictionary of a time entry.
+        :param n: position of the entry
+        :param start: start date string
+        :param stop: stop date string (ignored for running timers)
+        :return: dictionary
+        """
+        entry = {'id': n + 1, 'wid': WORKSPACE_ID, 'pid': int(self.pid[n]), 'billable': False,
+                 'start': start, 'duronly': False,
+                 'tags': [str(tag) for bit, tag in enumerate(self.tags[:3]) if self.tag_sets[n] >> bit & 1]}
+        if n < self.n_stopped:
+            entry['stop'] = stop
+            entry['duration'] = int(self.duration[n])
+        else:  # Running timers have a negative duration
+            entry['duration'] = -int(self.start[n])
+        return entry
+
+    def json_batches(self, start, end):
+        """
+        Write the time entries started between two times as a JSON array, a batch at a time. Like Toggl, at most
+        targets.TOGGL_PAGE_LIMIT entries are sent.
+        :param start: UNIX seconds
+        :param end: UNIX seconds
+        :return: generator of bytes
+        """
+        first = np.searchsorted(self.start[:self.n_stopped], start, side='left')
+        last = np.searchsorted(self.start[:self.n_stopped], end, side='right')
+        running = np.arange(self.n_stopped, len(self))
+        selected = np.append(np.arange(first, last), running[(self.start[running] >= start) &
+                                                              (self.start[running] <= end)])
+        selected = selected[:targets.TOGGL_PAGE_LIMIT]
+        yield b'['
+        for batch in range(0, len(selected), BATCH_SIZE):
+            entries = selected[batch:batch + BATCH_SIZE]
+            starts = np.datetime_as_string(self.start[entries].astype('datetime64[s]'))
+            stops = np.datetime_as_string(self.stop[entries].astype('datetime64[s]'))
+            prefix = b',' if batch > 0 else b''
+            yield prefix + ','.join(json.dumps(self.entry(n, start + '+00:00', stop + '+00:00'))
+                                    for n, start, stop in zip(entries.tolist(), starts, stops)).encode()
+        yield b']'
+
+
+class FakeToggl(ThreadingHTTPServer):
+    """
+    Local stand-in for the Toggl v8 API endpoints used by targets.py and projects.py.
+    """
+    daemon_threads = True
+
+    def __init__(self, data):
+        super().__init__(('127.0.0.1', 0), FakeTogglHandler)
+        self.data = data
+        self.bytes_sent = 0  # Bytes of time entries sent
+        self.requests = 0  # Number of time entry requests
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/api/v8'.format(self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):  # Kept alive connections closed by the client
+            super().handle_error(request, client_address)
+
+
+class FakeTogglHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections alive like Toggl
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        data = self.server.data
+        if url.path == '/api/v8/time_entries':
+            query = parse_qs(url.query)
+            start = int(datetime.fromisoformat(query['start_date'][0]).timestamp())
+            end = int(datetime.fromisoformat(query['end_date'][0]).timestamp())
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in data.json_batches(start, end):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                self.server.bytes_sent += len(chunk)
+            self.wfile.write(b'0\r\n\r\n')
+            self.server.requests += 1
+            return
+        if url.path == '/api/v8/time_entries/current':
+            start = str(np.datetime64(int(data.start[-1]), 's')) + '+00:00' if len(data) > data.n_stopped else None
+            body = {'data': data.entry(len(data) - 1, start, start) if start is not None else None}  # Last timer
+        elif url.path == '/api/v8/workspaces':
+            body = [{'id': WORKSPACE_ID, 'name': 'Benchmark'}]
+        elif url.path == '/api/v8/workspaces/{}/projects'.format(WORKSPACE_ID):
+            body = [{'id': int(pid), 'wid': WORKSPACE_ID, 'name': 'Project {}'.format(n)}
+                    for n, pid in enumerate(data.pids)]
+        else:
+            self.send_error(404)
+            return
+        body = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class NullWindow:
+    """
+    Stand-in for a curses window, so drawing can be timed without a terminal.
+    """
+
+    def __init__(self, height=60, width=120):
+        self.height = height
+        self.width = width
+        self.writes = 0
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def addstr(self, row, column, string, attributes=0):
+        self.writes += 1
+
+    def move(self, row, column):
+        pass
+
+    def clrtoeol(self):
+        pass
+
+    def clear(self):
+        pass
+
+    def refresh(self):
+        pass
+
+
+def measure(function, repeat=1, memory=True):
+    """
+    Time a function and find the most memory it allocates.
+    :param function: function without arguments
+    :param repeat: number of times to time it; the fastest is kept
+    :param memory: whether to run it once more to measure the memory (much slower)
+    :return: dictionary of 'seconds' and 'peak_bytes', and the result of the last call
+    """
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    stats = {'seconds': min(times)}
+    if memory:
+        tracemalloc.start()
+        result = function()
+        stats['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return stats, result
+
+
+def run(data, directory, repeat=5, memory=True):
+    """
+    Time each stage of the refresh and tick paths for one set of synthetic data.
+    :param data: SyntheticData
+    :param directory: empty directory for config.csv and the caches
+    :param repeat: number of times to time the fast stages
+    :param memory: whether to measure the memory of each stage
+    :return: dictionary of stage name -> measure() stats
+    """
+    server = FakeToggl(data)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    targets.API_URL = server.url
+    projects.API_URL = server.url
+    path = os.path.join(directory, 'config.csv')
+    data.config_csv(path)
+    stages = {}
+
+    def cold_sync():  # Full download with no local cache
+        account.cache = None
+        account.table = None
+        if os.path.exists(account.cache_file):
+            os.remove(account.cache_file)
+        return targets.query_toggl(account)
+
+    try:
+        stages['load_config'], config = measure(lambda: targets.load_config(path), repeat, memory)
+        semester = targets.current_semester_data(config)
+        account = targets.Account(config)
+        stages['cold_sync'], table = measure(cold_sync, 1, memory)
+        stages['cold_sync']['bytes'] = server.bytes_sent // (2 if memory else 1)
+        stages['cold_sync']['entries'] = len(table)
+        stages['warm_sync'], table = measure(lambda: targets.query_toggl(account), repeat, memory)
+        stages['probe'], nothing = measure(lambda: targets.request_current(account), repeat, memory)
+        stages['save_cache'], nothing = measure(lambda: targets.save_cache(account), repeat, memory)
+        stages['load_cache'], nothing = measure(lambda: targets.load_cache(account), repeat, memory)
+        stages['time_cube'], cube = measure(lambda: targets.TimeCube(config, table), repeat, memory)
+        stages['build_sections'], nothing = measure(lambda: targets.build_sections(config, semester, cube),
+                                                    repeat, memory)
+        screen = targets.Screen(NullWindow())
+
+        def draw():  # One tick of the dashboard
+            screen.print_reset()
+            targets.print_sections(screen, config, targets.build_sections(config, semester, cube))
+            screen.print_frame('0')
+
+        stages['draw'], nothing = measure(draw, repeat, memory)
+        days = np.arange(int(config.calendar.day(targets.current_time())) + 1)
+        stages['history'], nothing = measure(lambda: targets.history(config, cube, days), 1, memory)
+        stages['projects'], nothing = measure(lambda: projects.fetch_projects(config.api_token), repeat, memory)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return stages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time targets.py on synthetic Toggl data and print JSON.')
+    parser.add_argument('sizes', nargs='*', type=int, default=SIZES, help='numbers of time entries')
+    parser.add_argument('--projects', type=int, default=10, help='number of tracked projects')
+    parser.add_argument('--tags', type=int, default=5, help='number of tags')
+    parser.add_argument('--running', type=int, default=1, help='number of running timers')
+    parser.add_argument('--repeat', type=int, default=5, help='times to run the fast stages; the fastest is kept')
+    parser.add_argument('--no-memory', action='store_true', help="don't measure memory (faster)")
+    parser.add_argument('--output', help='file to save the JSON to instead of printing it')
+    args = parser.parse_args(argv)
+
+    results = {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+               'projects': args.projects, 'tags': args.tags, 'running': args.running, 'sizes': {}}
+    for size in args.sizes:
+        data = SyntheticData(size, args.projects, args.tags, args.running)
+        with tempfile.TemporaryDirectory() as directory:
+            results['sizes'][str(size)] = run(data, directory, args.repeat, not args.no_memory)
+        print('Finished {} entries'.format(size), file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,45 +2,164 @@
 
 # Load requirements
 import sys
+import os
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from requests.auth import HTTPBasicAuth
 
-# Get Toggl API Token
-try:
-    API_TOKEN = str(sys.argv[1])
-except (ValueError, IndexError) as e:
-    print("Toggl API token must be provided!")
-    sys.exit(1)
-
-url = 'https://api.track.toggl.com/api/v8/workspaces'
-headers = {'content-type': 'application/json'}
-
-# Get workspace
-r = requests.get(url, headers=headers, auth=HTTPBasicAuth(API_TOKEN, 'api_token'))
-r.raise_for_status()  # Check if there was an error
-
-workspaces = r.json()
-
-print("Select the workplace:")
-i = 0
-for workspace in workspaces:
-    i += 1
-    print(i, ':', workspace['name'])
-
-try:
-    wid = int(input())
-    assert 1 <= wid <= i
-except (ValueError, AssertionError) as e:
-    print("ERROR: Bad choice.")
-    sys.exit(1)
-
-# Get project
-r = requests.get(url + '/' + str(workspaces[wid-1]['id']) + '/projects',
-                 headers=headers, auth=HTTPBasicAuth(API_TOKEN, 'api_token'))
-r.raise_for_status()  # Check if there was an error
-
-projects = r.json()
-
-print("Project ID")
-for project in projects:
-    print(project['id'], project['name'])
+API_URL = 'https://api.track.toggl.com/api/v8'  # Toggl API the workspaces and projects are read from
+CACHE_FILE = 'projects_cache.json'  # Local copy of the workspaces and projects of the last accounts listed
+CACHE_TTL = 60 * 60  # Seconds the local copy is used for before asking Toggl again
+FETCH_WORKERS = 8  # Most workspaces to ask Toggl for the projects of at once
+REQUEST_TIMEOUT = (10, 60)  # Seconds to wait for Toggl to accept the connection and to send the data
+
+
+def make_session(api_token):
+    """
+    Make a connection to Toggl that is kept alive between requests.
+    :param api_token: Toggl API token
+    :return: requests.Session
+    """
+    session = requests.Session()
+    session.headers.update({'content-type': 'application/json'})
+    session.auth = HTTPBasicAuth(api_token, 'api_token')
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=FETCH_WORKERS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_json(session, path):
+    """
+    Ask the Toggl API for something.
+    :param session: requests.Session
+    :param path: path after API_URL, e.g. '/workspaces'
+    :return: decoded JSON response
+    """
+    r = session.get(API_URL + path, timeout=REQUEST_TIMEOUT)
+    r.raise_for_status()  # Check if there was an error
+    return r.json()
+
+
+def fetch_projects(api_token):
+    """
+    Get every workspace of an account and all of their projects, asking for the workspaces' projects at the same time.
+    :param api_token: Toggl API token
+    :return: list of workspace dictionaries, each with a list of its project dictionaries under 'projects'
+    """
+    with make_session(api_token) as session:
+        workspaces = get_json(session, '/workspaces')
+        if len(workspaces) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(workspaces))) as executor:
+            projects = executor.map(lambda workspace: get_json(session, '/workspaces/{}/projects'.format(
+                workspace['id'])), workspaces)
+            return [{'id': workspace['id'], 'name': workspace['name'],
+                     'projects': [{'id': project['id'], 'name': project['name']} for project in found or []]}
+                    for workspace, found in zip(workspaces, projects)]  # Toggl sends null for no projects
+
+
+def cached_projects(api_token, path=CACHE_FILE):
+    """
+    Get every workspace of an account and all of their projects, from the local copy if it is for the same account
+    and less than CACHE_TTL old, and from Toggl otherwise.
+    :param api_token: Toggl API token
+    :param path: file to keep the local copy in
+    :return: list of workspace dictionaries, each with a list of its project dictionaries under 'projects'
+    """
+    account = hashlib.sha1(api_token.encode()).hexdigest()  # Don't keep the token itself
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        if cache['account'] == account and 0 <= time.time() - cache['time'] < CACHE_TTL:
+            return cache['workspaces']
+    except (OSError, ValueError, KeyError):  # Missing or corrupt; ask Toggl
+        pass
+    workspaces = fetch_projects(api_token)
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'account': account, 'time': time.time(), 'workspaces': workspaces}, f)
+        os.replace(path + '.tmp', path)  # Never leave a half written copy behind
+    except OSError:  # Still works without a copy
+        pass
+    return workspaces
+
+
+def config_rows(workspaces, semester='ALL', total_hours=0):
+    """
+    Make a row of config.csv for every project, with only the PROJECT_NAME, PID, SEMESTER and TOTAL_HOURS columns
+    filled in, so the rows can be pasted below the last line of config.csv.
+    :param workspaces: cached_projects() output
+    :param semester: name of the semester to give each project
+    :param total_hours: number of hours to give each project
+    :return: list of strings
+    """
+    rows = []
+    for workspace in workspaces:
+        for project in workspace['projects']:
+            name = ' '.join(project['name'].replace(',', ' ').replace('#', ' ').split())  # Can't be read in a CSV
+            rows.append(',,,,,{},{},{},{},,'.format(name, project['id'], semester, total_hours))  # 11 columns
+    return rows
+
+
+def choose_projects(api_token):
+    """
+    Ask which workspace to list the projects of, and print their IDs.
+    :param api_token: Toggl API token
+    :return: nothing
+    """
+    with make_session(api_token) as session:
+        # Get workspace
+        workspaces = get_json(session, '/workspaces')
+
+        print("Select the workplace:")
+        i = 0
+        for workspace in workspaces:
+            i += 1
+            print(i, ':', workspace['name'])
+
+        try:
+            wid = int(input())
+            assert 1 <= wid <= i
+        except (ValueError, AssertionError) as e:
+            print("ERROR: Bad choice.")
+            sys.exit(1)
+
+        # Get project
+        projects = get_json(session, '/workspaces/' + str(workspaces[wid-1]['id']) + '/projects') or []
+
+    print("Project ID")
+    for project in projects:
+        print(project['id'], project['name'])
+
+
+def main(argv=None):
+    """
+    Run the script from the command line.
+    :param argv: list of arguments; defaults to sys.argv[1:]
+    :return: nothing
+    """
+    argv = sys.argv[1:] if argv is None else argv
+
+    # Get Toggl API Token
+    try:
+        api_token = str(argv[0])
+    except (ValueError, IndexError) as e:
+        print("Toggl API token must be provided!")
+        sys.exit(1)
+
+    if len(argv) > 1 and argv[1] == '-a':  # All workspaces, without asking
+        semester = argv[2] if len(argv) > 2 else 'ALL'
+        total_hours = argv[3] if len(argv) > 3 else 0
+        for row in config_rows(cached_projects(api_token), semester, total_hours):
+            print(row)
+        return
+
+    choose_projects(api_token)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# Load requirements
+import json
+import time
+import hmac
+import hashlib
+import argparse
+from datetime import datetime, timezone, timedelta
+import requests
+import targets
+
+DEMO_ID = 9 * 10 ** 12  # First time entry id of the demo events; far above real ids
+
+
+def event(action, entry, created_at):
+    """
+    Make a Toggl webhook event (API v9) about a time entry.
+    :param action: 'created', 'updated' or 'deleted'
+    :param entry: time entry dictionary
+    :param created_at: datetime of the event
+    :return: dictionary
+    """
+    return {'event_id': int(created_at.timestamp() * 1000), 'created_at': created_at.isoformat(),
+            'metadata': {'action': action, 'model': 'time_entry'}, 'payload': dict(entry)}
+
+
+def demo_events(config):
+    """
+    Make a short session of events for the first tracked project: a timer is started, tagged, stopped, and another
+    entry is added and then deleted.
+    :param config: Config
+    :return: list of event dictionaries
+    """
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    pid = int(config.project_data[0, 1])
+    tags = list(config.tracked_tags[:2, 0])
+    start = now - timedelta(minutes=30)
+    timer = {'id': DEMO_ID, 'project_id': pid, 'description': 'Replayed timer', 'start': start.isoformat(),
+             'stop': None, 'duration': -int(start.timestamp()), 'tags': tags[:1]}
+    events = [event('created', timer, now)]
+    timer['tags'] = tags
+    events.append(event('updated', timer, now))
+    timer.update(stop=now.isoformat(), duration=30 * 60)
+    events.append(event('updated', timer, now))
+    start = now - timedelta(hours=3)
+    entry = {'id': DEMO_ID + 1, 'project_id': pid, 'description': 'Replayed entry', 'start': start.isoformat(),
+             'stop': (start + timedelta(hours=1)).isoformat(), 'duration': 60 * 60, 'tags': []}
+    events.append(event('created', entry, now))
+    events.append(event('deleted', entry, now))
+    return events
+
+
+def post(session, url, event, secret=''):
+    """
+    Send an event to a webhook receiver, signed like Toggl signs them if there is a secret.
+    :param session: requests.Session
+    :param url: URL of the receiver
+    :param event: event dictionary
+    :param secret: webhook secret, or '' to not sign it
+    :return: HTTP status code
+    """
+    body = json.dumps(event).encode()
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers['X-Webhook-Signature-256'] = 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return session.post(url, data=body, headers=headers, timeout=targets.REQUEST_TIMEOUT).status_code
+
+
+def main(argv=None):
+    """
+    Run the script from the command line.
+    :param argv: list of arguments; defaults to sys.argv[1:]
+    :return: nothing
+    """
+    parser = argparse.ArgumentParser(description='Send Toggl webhook events to a local receiver (targets.py -w).')
+    parser.add_argument('events', nargs='?', help='file with one event as JSON per line; a demo session if not given')
+    parser.add_argument('--url', default='http://127.0.0.1:{}/'.format(targets.WEBHOOK_PORT), help='receiver URL')
+    parser.add_argument('--config', default=targets.CONFIG_FILE, help='config.csv to sign and make demo events for')
+    parser.add_argument('--delay', type=float, default=1, help='seconds to wait between events')
+    args = parser.parse_args(argv)
+
+    config = targets.load_config(args.config)
+    if args.events is None:
+        events = demo_events(config)
+    else:
+        with open(args.events) as f:
+            events = [json.loads(line) for line in f if line.strip() != '']
+
+    with requests.Session() as session:
+        for n, item in enumerate(events):
+            if n > 0:
+                time.sleep(args.delay)
+            metadata = item.get('metadata') or {}
+            print(post(session, args.url, item, config.webhook_secret), metadata.get('action'),
+                  (item.get('payload') or {}).get('id'))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,339 +4,1137 @@
 import numpy as np
 from datetime import datetime, timezone, timedelta
 import sys
+import os
+import json
+import pickle
 import logging
 import time
-import requests
+import functools
+import itertools
+import random
+import codecs
+import threading
+import collections
+import contextlib
+import csv
+import unicodedata
+import select
+import signal
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import hmac
+import copy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import urlencode
-from requests.auth import HTTPBasicAuth
 import curses  # UNIX, MacOS
+# requests is only imported when Toggl is first contacted as it is slow to import
+
+CONFIG_FILE = 'config.csv'  # Settings, weeks, projects and tags
+CONFIG_CACHE_VERSION = 8  # Increase when Config changes so old compiled copies of config.csv are ignored
+CONFIG_CHECK_INTERVAL = 2  # Seconds between checks of whether config.csv has been edited while running
+API_URL = 'https://api.track.toggl.com/api/v8'
+REQUEST_TIMEOUT = (10, 60)  # Seconds to wait for Toggl to accept the connection and to send the data
+RETRY_DELAY = 5  # Seconds to wait before retrying a failed refresh; doubled after each failure
+MAX_RETRY_DELAY = 10 * 60  # Longest wait between retries
+MAX_STALENESS = 15 * 60  # Default seconds between syncs when the running timer doesn't change (MAX_STALENESS setting)
+MAX_PROBE_INTERVAL = 5 * 60  # Longest wait between checks of the running timer when no timer is running
+CACHE_FILE = 'toggl_cache.npz'  # Local copy of the processed Toggl time entries, keyed by entry id
+SYNC_OVERLAP = timedelta(days=2)  # Re-fetch entries started this long before the last sync to catch recent edits
+FULL_SYNC_INTERVAL = timedelta(days=1)  # Reconcile the incomplete windows this often to catch edits and deletions
+WINDOW_SETTLE = timedelta(days=14)  # A month that ended this long ago is complete and never requested again
+FETCH_WORKERS = 4  # Most months to request from Toggl at once
+FETCH_RETRIES = 3  # Attempts at requesting a month before giving up on the sync
+TOGGL_PAGE_LIMIT = 1000  # Most time entries Toggl returns for one request; a full response is continued
+HISTORY_FILE = 'history.csv'  # Default output of the batch time machine
+STATS_PORT = 8642  # Default local port of the stats server
+WEBHOOK_PORT = 8643  # Default local port of the webhook receiver
+SYNC_WORKERS = 8  # Most accounts to sync with Toggl at once in team mode
+METRICS_WINDOW = 256  # Number of recent runs of each phase to find the timing percentiles from
+METRICS_INTERVAL = 5 * 60  # Seconds between writing the timings to the log
+
+TIME_MACHINE_DATE = None  # Static current time given at launch with '-t'; None to use the real time
+DAY_START_HOUR = 3  # Days start and end at 3 AM local time
 
-logging.basicConfig(filename='targets.log', level=logging.DEBUG)
 
-# Load config.csv
+def current_time():
+    """
+    Determine the current time to be used in the program. A static current time can be defined at launch with '-t'.
+    :return: UNIX seconds
+    """
+    if TIME_MACHINE_DATE is not None:
+        return int(TIME_MACHINE_DATE.timestamp())
+    else:
+        return int(time.time())
 
-config_file = np.genfromtxt('config.csv', delimiter=',', skip_header=1, dtype=object)
 
-API_TOKEN = config_file[0, 0].decode('utf-8')  # API token for Toggl
-REFRESH_RATE = int(config_file[2, 0].decode('utf-8'))  # Number of 1 s to wait before getting new data from Toggl
-TOGGL_ERROR = False  # Initialise error display variable
-loops = 0  # Counter to determine when to refresh Toggl data
+class Calendar:
+    """
+    Start times of the days and weeks of the academic year, in UNIX seconds. Days start at 3 AM local time, including
+    across daylight saving changes, so a day is not always 24 hours long. Times are mapped to days and weeks with a
+    binary search, which also works on whole arrays of times.
+    """
 
-semester_data = np.array(config_file[:, 1:5], dtype='U')  # Columns SEMESTER to WORKLOAD
-semester_data = semester_data[list(set(semester_data.nonzero()[0]))]
-n_semesters = len(np.where(semester_data[:, 0] != '')[0])  # Number of semesters
+    def __init__(self, first_day, n_weeks):
+        """
+        :param first_day: date string of the first day of the year, e.g. '2018-09-01'
+        :param n_weeks: number of weeks in the year
+        """
+        year, month, day = (int(part) for part in first_day.split('-'))
+        # mktime() normalises days past the end of the month and finds the UTC offset of each day (isdst=-1)
+        self.days = np.array([time.mktime((year, month, day + n, DAY_START_HOUR, 0, 0, 0, 0, -1))
+                              for n in range(7 * n_weeks + 1)], dtype=np.int64)  # Start of each day, then the end
+        self.weeks = self.days[::7]  # Start of each week, then the end of the year
+
+    def day(self, seconds):
+        """
+        Find the day that a time falls in.
+        :param seconds: UNIX seconds, or numpy array of them
+        :return: day number (0 for the first day of the year); -1 before the year starts
+        """
+        return np.searchsorted(self.days, seconds, side='right') - 1
+
+    def week(self, seconds):
+        """
+        Find the week that a time falls in.
+        :param seconds: UNIX seconds, or numpy array of them
+        :return: week number (0 for the first week of the year); -1 before the year starts
+        """
+        return np.searchsorted(self.weeks, seconds, side='right') - 1
+
+
+class Metrics:
+    """
+    Timings of each phase of the refreshes and of the display, kept for the last METRICS_WINDOW times each phase ran,
+    and the latest counts (e.g. entries and bytes fetched). Recording a time is a clock read and a deque append, so
+    it is always on.
+    """
 
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.spans = {}  # Phase name -> deque of seconds
+        self.counts = {}  # Count name -> latest value
+        self.next_dump = time.time() + METRICS_INTERVAL  # time.time() to next write the summary to the log
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Time the code in a with block as one run of a phase.
+        :param name: name of the phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        """
+        Record one run of a phase.
+        :param name: name of the phase
+        :param seconds: time it took
+        :return: nothing
+        """
+        spans = self.spans.get(name)
+        if spans is None:
+            spans = self.spans.setdefault(name, collections.deque(maxlen=self.window))
+        spans.append(seconds)
+
+    def count(self, name, value):
+        """
+        Record the latest value of a count.
+        :param name: name of the count
+        :param value: number
+        :return: nothing
+        """
+        self.counts[name] = value
+
+    def summary(self):
+        """
+        Summarise the recent timings.
+        :return: dictionary of phase name -> number of runs and 50th, 90th and 99th percentile and maximum milliseconds,
+        and 'counts'
+        """
+        summary = {}
+        for name, spans in list(self.spans.items()):
+            milliseconds = np.array(spans) * 1000
+            p50, p90, p99 = np.percentile(milliseconds, [50, 90, 99])
+            summary[name] = {'n': len(milliseconds), 'p50': round(p50, 3), 'p90': round(p90, 3),
+                             'p99': round(p99, 3), 'max': round(float(milliseconds.max()), 3)}
+        summary['counts'] = dict(self.counts)
+        return summary
+
+    def status(self):
+        """
+        Describe the recent timings in one line: the median and 90th percentile milliseconds of each phase, and the
+        counts.
+        :return: string
+        """
+        parts = []
+        for name, spans in list(self.spans.items()):
+            p50, p90 = np.percentile(spans, [50, 90]) * 1000
+            parts.append('{} {:.1f}/{:.1f}'.format(name, p50, p90))
+        parts += ['{} {}'.format(name, value) for name, value in self.counts.items()]
+        return 'ms p50/p90: ' + ' | '.join(parts)
+
+    def dump(self, name):
+        """
+        Write the summary to the log if it has not been written for METRICS_INTERVAL.
+        :param name: name of the account the timings are for
+        :return: nothing
+        """
+        if time.time() >= self.next_dump:
+            self.next_dump = time.time() + METRICS_INTERVAL
+            logging.info('Timings for %s: %s', name, json.dumps(self.summary()))
+
+
+class Config:
+    """
+    Settings, weeks, projects and tags read from config.csv.
+    """
 
-def quantise_date(date):
+    def __init__(self, config_file, path=CONFIG_FILE):
+        """
+        :param config_file: numpy array of the cells of config.csv, without the header
+        :param path: path of config.csv
+        """
+        self.path = path
+        self.api_token = config_file[0, 0].decode('utf-8')  # API token for Toggl
+        self.refresh_rate = int(config_file[2, 0].decode('utf-8'))  # Number of 1 s to wait before checking Toggl
+        settings = np.array(config_file[:, 0], dtype='U')
+        settings = dict(zip(settings[1::2], settings[2::2]))  # Optional settings after REFRESH_RATE; name then value
+        self.max_staleness = int(settings.get('MAX_STALENESS', MAX_STALENESS))  # Most seconds between syncs
+        self.webhook_secret = settings.get('WEBHOOK_SECRET', '')  # Secret that Toggl signs webhook events with
+        self.rolling_days = [int(n) for n in settings.get('ROLLING_DAYS', '').split(';') if n != '']  # Days/section
+        self.tag_split = settings.get('TAG_SPLIT', 'FIRST').upper()  # How to share an entry's time between its tags
+        if self.tag_split not in ('FIRST', 'EQUAL', 'WEIGHTED'):
+            raise ValueError('TAG_SPLIT must be FIRST, EQUAL or WEIGHTED, not {}'.format(self.tag_split))
+
+        semester_data = np.array(config_file[:, 1:5], dtype='U')  # Columns SEMESTER to WORKLOAD
+        self.semester_data = semester_data[list(set(semester_data.nonzero()[0]))]
+        self.n_semesters = len(np.where(self.semester_data[:, 0] != '')[0])  # Number of semesters
+        self.calendar = Calendar(self.semester_data[0, 2], len(self.semester_data))  # Days and weeks of the year
+        self.start_date = datetime.fromtimestamp(self.calendar.days[0], timezone.utc)  # Start of the first week
+
+        project_data = np.array(config_file[:, 5:9], dtype='U')  # 4 columns from project name to total wl
+        self.project_data = project_data[list(set(project_data.nonzero()[0]))]
+
+        tracked_tags = np.array(config_file[:, 9:11], dtype='U')  # Columns TRACKED_TAGS and TAG_SYMBOL
+        tag_rows = list(set(tracked_tags.nonzero()[0]))
+        self.tracked_tags = tracked_tags[tag_rows]
+        tag_weights = np.array(config_file[tag_rows, 11:12], dtype='U').ravel()  # Optional TAG_WEIGHT column
+        self.tag_weights = np.ones(len(tag_rows))  # Share of an entry's time for each tag when TAG_SPLIT is WEIGHTED
+        self.tag_weights[:len(tag_weights)][tag_weights != ''] = tag_weights[tag_weights != ''].astype(float)
+
+        # Toggl pid -> pid code; the pid code is the row of the module in project_data (name, pid, semester, hours)
+        self.project_index = {int(pid): code for code, pid in enumerate(self.project_data[:, 1])}
+        self.tag_index = {tag: code for code, tag in enumerate(self.tracked_tags[:, 0])}  # Toggl tag -> tag code
+        self.all_year_projects = np.where(self.project_data[:, 2] == "ALL")[0]  # pid codes
+
+        # Workload of each project for each week, compiled once into a (week, pid code) matrix
+        pids = self.project_data[:, 1]
+        workload_table = np.zeros((len(self.semester_data), len(pids)), dtype=float)
+        for week, cell in enumerate(self.semester_data[:, 3]):
+            cases = cell.split(';')
+            workload_table[week] = float(cases[0])  # Default for the week
+            for case in cases[1:]:  # Custom values for projects, as pid:workload
+                pid, workload = case.split(':')
+                workload_table[week, pids == pid] = float(workload)
+        self.workload_table = workload_table
+        # Row n is the total workload of weeks 0 to n-1, so the workload of any range of weeks is one subtraction
+        self.cum_workload_table = np.concatenate((np.zeros((1, len(pids))), np.cumsum(workload_table, axis=0)))
+        self.semester_starts = np.where(self.semester_data[:, 0] != '')[0]  # First week of each semester
+        self.week_semesters = np.searchsorted(self.semester_starts, np.arange(len(self.semester_data)),
+                                              side='right') - 1  # Semester of each week
+
+        # Fraction of each project's semester workload for each day, with row n the total before day n
+        n_weeks = len(self.semester_data)
+        semester_ends = np.append(self.semester_starts[1:], n_weeks)[self.week_semesters]  # End of each week's semester
+        semester_starts = self.semester_starts[self.week_semesters]
+        semester_workload = self.cum_workload_table[np.minimum(semester_ends + 1, n_weeks)] - \
+            self.cum_workload_table[semester_starts]  # Same total as current_semester_data()
+        in_semester = (self.project_data[:, 2] == self.semester_data[semester_starts, 0][:, None]) | \
+            (self.project_data[:, 2] == "ALL")  # Only count weeks in each project's semester
+        week_workload = np.divide(workload_table, semester_workload, out=np.zeros(workload_table.shape),
+                                  where=in_semester & (semester_workload != 0))
+        day_workload = np.repeat(week_workload / 7, 7, axis=0)
+        self.cum_day_workload = np.concatenate((np.zeros((1, len(pids))), np.cumsum(day_workload, axis=0)))
+
+
+def load_config(path=CONFIG_FILE):
     """
-    Convert a datetime object into a UTC datetime object for the start of the day; defined as local 3 AM of given day.
-    :param date: datetime object
-    :return: datetime object of start of given day in UTC
+    Read config.csv. The parsed config is saved in a compiled form beside it and reused until config.csv is modified.
+    :param path: path of config.csv
+    :return: Config
     """
-    def to_datetime(date_string):
-        return datetime.strptime(date_string, '%Y-%m-%d %H:%M:%S%z').astimezone(timezone.utc)
+    stat = os.stat(path)
+    stamp = (CONFIG_CACHE_VERSION, os.path.abspath(path), stat.st_mtime_ns, stat.st_size,
+             time.tzname, time.timezone, time.altzone)  # The calendar depends on the local time zone
+    cache_path = os.path.splitext(path)[0] + '.cache'
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_stamp, config = pickle.load(f)
+        if cached_stamp == stamp:
+            return config
+    except (OSError, EOFError, ValueError, AttributeError, ImportError, pickle.UnpicklingError):
+        pass  # Missing, corrupt or from another version; compile it again
+
+    config = Config(np.genfromtxt(path, delimiter=',', skip_header=1, dtype=object), path)
+    try:
+        with open(cache_path + '.tmp', 'wb') as f:
+            pickle.dump((stamp, config), f)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError as e:  # Not needed to run
+        logging.error('Could not save the compiled config. %s', e)
+    return config
 
-    local_date = date.astimezone(LOCAL_TIMEZONE)
-    hour = int(local_date.strftime('%H'))
-    if hour >= 3:  # In current day
-        return to_datetime(local_date.strftime('%Y-%m-%d 03:00:00%z'))
-    else:  # In previous day
-        return to_datetime(local_date.strftime('%Y-%m-%d 03:00:00%z')) - timedelta(days=1)
 
+class Semester:
+    """
+    Details of the current semester and week, and the workloads for them, produced by current_semester_data().
+    """
 
-LOCAL_TIMEZONE = datetime.now(timezone.utc).astimezone().tzinfo
-GLOBAL_START_DATE = quantise_date(
-    datetime.strptime(semester_data[0, 2], '%Y-%m-%d').replace(tzinfo=LOCAL_TIMEZONE) + timedelta(hours=6)
-)  # Start date of the first week with days starting at 3 AM
-TIME_MACHINE = False  # Default to current time
+    def __init__(self, config, name, start, end, week, week_start, week_end, workload, cum_workload):
+        self.config = config  # Config the workloads are from
+        self.name = name  # Name of semester
+        self.start = start  # UNIX seconds
+        self.end = end
+        self.week = week  # Name of week
+        self.week_start = week_start
+        self.week_end = week_end
+        self.workload = workload  # Fraction of each project's semester workload for the current week
+        self.cum_workload = cum_workload  # Cumulative fraction for the semester so far
+        project_data = config.project_data
+        self.projects = np.where((project_data[:, 2] == name) | (project_data[:, 2] == "ALL"))[0]  # pid codes
+
+
+def current_semester_data(config):
+    """
+    Get details of the current semester and week, and calculate workloads.
+    :param config: Config
+    :return: Semester
+    """
+    weeks = config.calendar.weeks
+    n_weeks = int(config.calendar.week(current_time()))  # Current week number -1
+    if n_weeks < 0:
+        raise ValueError("Year hasn't started yet. Try after " +
+                         datetime.fromtimestamp(weeks[0]).strftime('%Y-%m-%d %H:%M:%S'))
 
-if len(sys.argv) > 1:  # Parse time machine data from given arguments
-    if sys.argv[1] == '-t':
-        TIME_MACHINE = True
-        try:  # Check that the date is valid
-            TIME_MACHINE_DATE = datetime.strptime(sys.argv[2] + ' ' + sys.argv[3],
-                                                  '%Y-%m-%d %H:%M:%S').replace(tzinfo=LOCAL_TIMEZONE)
-            TIME_MACHINE_DATE_STR = TIME_MACHINE_DATE.strftime('%a, %Y-%m-%d %H:%M:%S')
-        except (ValueError, IndexError) as e:
-            print("Invalid Time Machine Date. Required format: YYYY-MM-DD HH:MM:SS")
-            sys.exit(1)
+    semester_data = config.semester_data
+    if n_weeks + 1 > len(semester_data):
+        raise ValueError("Year has ended. Use the time machine to access previous dates.")
 
+    # Find when the semester starts and ends
+    semester = config.week_semesters[n_weeks]
+    semester_starts = int(config.semester_starts[semester])
+    if semester + 1 < len(config.semester_starts):
+        semester_ends = int(config.semester_starts[semester + 1])
+    else:
+        semester_ends = len(semester_data)
 
-def current_time():
+    semester_name = semester_data[semester_starts][0]  # Name of semester
+    week = semester_data[n_weeks, 1]  # Name of week
+
+    # Fractional workload for week in semester
+    cum_workload_table = config.cum_workload_table
+    semester_total_workload = cum_workload_table[min(semester_ends + 1, len(semester_data))] - \
+        cum_workload_table[semester_starts]
+    semester_so_far_workload = cum_workload_table[n_weeks + 1] - cum_workload_table[semester_starts]
+    week_workload = config.workload_table[n_weeks]
+
+    workload = week_workload / semester_total_workload  # Workload for current week
+    cum_workload = semester_so_far_workload / semester_total_workload  # Cumulative workload for semester
+
+    return Semester(config, semester_name, weeks[semester_starts], weeks[semester_ends], week, weeks[n_weeks],
+                    weeks[n_weeks + 1], workload, cum_workload)
+
+
+def tag_codes(config, tags):
     """
-    Determine the current time to be used in the program. A static current time can be defined at launch with '-t'.
-    :return: datetime object
+    Find the tracked tags among an entry's tags.
+    :param config: Config
+    :param tags: list of Toggl tags, or None
+    :return: list of tag codes (rows of the tags in the tracked tags), in the order given
     """
-    if TIME_MACHINE:
-        return TIME_MACHINE_DATE.astimezone(timezone.utc)
-    else:
-        return datetime.now(timezone.utc)
+    return [config.tag_index[tag] for tag in tags or () if tag in config.tag_index]
 
 
-project_data = np.array(config_file[:, 5:9], dtype='U')  # 4 columns from project name to total wl of config.csv
-project_data = project_data[list(set(project_data.nonzero()[0]))]
+class EntryStore:
+    """
+    Table of time entries stored as one typed numpy array per column.
+    Columns: Toggl entry id, start and stop (UNIX seconds, stop is -1 while running), duration (seconds) and pid code
+    (row of the project in project_data). The tracked tags of the entries are a sparse entry x tag incidence matrix in
+    coordinate form: tag_row (row of the entry) and tag_code (row of the tag in the tracked tags), sorted by row and
+    then in the order Toggl gave the tags.
+    Appends double the capacity when it runs out, so building a table of n entries is O(n). Once sorted by start
+    time, the entries up to a time are found with a binary search and taken as a slice.
+    """
+    columns = (('id', np.int64), ('start', np.int64), ('stop', np.int64), ('duration', np.int64),
+               ('pid', np.int32))
+    tag_columns = (('tag_row', np.int64), ('tag_code', np.int32))
 
-TRACKED_TAGS = np.array(config_file[:5, 9:11], dtype='U')  # 5 tags max
-TRACKED_TAGS = TRACKED_TAGS[list(set(TRACKED_TAGS.nonzero()[0]))]
+    def __init__(self, capacity=256):
+        self.size = 0
+        self.n_tags = 0  # Number of (entry, tag) pairs
+        self.version = 0  # Account version when the time entries were downloaded
+        self._data = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.columns}
+        self._tags = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.tag_columns}
 
+    def __len__(self):
+        return self.size
 
-def current_semester_data():
+    def __getattr__(self, name):  # Views of the filled part of each column, e.g. store.start
+        try:
+            if name in self.__dict__['_tags']:
+                return self.__dict__['_tags'][name][:self.__dict__['n_tags']]
+            return self.__dict__['_data'][name][:self.__dict__['size']]
+        except KeyError:
+            raise AttributeError(name)
+
+    def append(self, entry_id, start, stop, duration, pid, tags=()):
+        """
+        Add a time entry to the end of the table.
+        :param tags: tag codes of the entry's tracked tags
+        :return: nothing
+        """
+        if self.size == len(self._data['id']):  # Full; double the capacity
+            for name, column in self._data.items():
+                self._data[name] = np.resize(column, max(2 * len(column), 1))
+        for name, value in zip(self._data, (entry_id, start, stop, duration, pid)):
+            self._data[name][self.size] = value
+        for code in tags:
+            if self.n_tags == len(self._tags['tag_row']):
+                for name, column in self._tags.items():
+                    self._tags[name] = np.resize(column, max(2 * len(column), 1))
+            self._tags['tag_row'][self.n_tags] = self.size
+            self._tags['tag_code'][self.n_tags] = code
+            self.n_tags += 1
+        self.size += 1
+
+    def _reindex_tags(self, rows):
+        """
+        Move the tags to the new rows of their entries, dropping those of entries that were left out.
+        :param rows: numpy array of the new row of each old row, or -1 if left out
+        :return: dictionary of tag columns
+        """
+        rows = rows[self.tag_row]
+        kept = np.nonzero(rows >= 0)[0]
+        kept = kept[np.argsort(rows[kept], kind='stable')]  # Keep each entry's tags in order
+        return {'tag_row': rows[kept], 'tag_code': self.tag_code[kept]}
+
+    def sort(self):
+        """
+        Sort the time entries by start time.
+        :return: nothing
+        """
+        order = np.argsort(self.start, kind='stable')
+        rows = np.empty(self.size, dtype=np.int64)
+        rows[order] = np.arange(self.size)
+        self._tags = self._reindex_tags(rows)
+        self._data = {name: getattr(self, name)[order] for name in self._data}
+
+    def extend(self, other):
+        """
+        Add the time entries of another table to the end of this one.
+        :param other: EntryStore
+        :return: nothing
+        """
+        self._tags = {'tag_row': np.concatenate((self.tag_row, other.tag_row + self.size)),
+                      'tag_code': np.concatenate((self.tag_code, other.tag_code))}
+        self.n_tags += other.n_tags
+        for name in self._data:
+            self._data[name] = np.concatenate((getattr(self, name), getattr(other, name)))
+        self.size += other.size
+
+    def equals(self, other):
+        """
+        Check whether two tables hold the same time entries in the same order.
+        :param other: EntryStore
+        :return: boolean
+        """
+        return self.size == other.size and self.n_tags == other.n_tags and \
+            all(np.array_equal(getattr(self, name), getattr(other, name)) for name in (*self._data, *self._tags))
+
+    def take(self, index):
+        """
+        Select a subset of the time entries.
+        :param index: boolean mask, integer indices (without repeats) or slice
+        :return: new EntryStore
+        """
+        subset = EntryStore(capacity=0)
+        subset.version = self.version
+        subset._data = {name: getattr(self, name)[index] for name in self._data}
+        subset.size = len(subset._data['id'])
+        rows = np.full(self.size, -1, dtype=np.int64)
+        rows[np.arange(self.size)[index]] = np.arange(subset.size)
+        subset._tags = self._reindex_tags(rows)
+        subset.n_tags = len(subset._tags['tag_row'])
+        return subset
+
+    def recode(self, pid_map, tag_map):
+        """
+        Move the time entries to new pid and tag codes, dropping those of projects and tags that are no longer tracked.
+        :param pid_map: numpy array of the new pid code of each old pid code, or -1 if no longer tracked
+        :param tag_map: numpy array of the new tag code of each old tag code, or -1 if no longer tracked
+        :return: new EntryStore
+        """
+        table = self.take(np.nonzero(pid_map[self.pid] >= 0)[0])
+        table._data['pid'] = pid_map[table.pid].astype(np.int32)
+        codes = tag_map[table.tag_code]
+        kept = codes >= 0
+        table._tags = {'tag_row': table.tag_row[kept], 'tag_code': codes[kept].astype(np.int32)}
+        table.n_tags = int(np.count_nonzero(kept))
+        return table
+
+    def tag_matrix(self, config):
+        """
+        Share the time of each entry between its tracked tags, as set by TAG_SPLIT: all to the first (FIRST), equally
+        (EQUAL) or in proportion to TAG_WEIGHT (WEIGHTED). Time not given to a tracked tag goes to column 0.
+        :param config: Config
+        :return: sparse entry x (tag code + 1) matrix of the fractions in coordinate form: rows, columns and fractions
+        """
+        rows, codes = self.tag_row, self.tag_code
+        if config.tag_split == 'FIRST':
+            first = np.ones(len(rows), dtype=bool)
+            first[1:] = rows[1:] != rows[:-1]
+            rows, codes = rows[first], codes[first]
+            fractions = np.ones(len(rows))
+        else:
+            weights = config.tag_weights[codes] if config.tag_split == 'WEIGHTED' else np.ones(len(rows))
+            totals = np.bincount(rows, weights=weights, minlength=self.size)[rows]
+            fractions = np.divide(weights, totals, out=np.zeros(len(rows)), where=totals != 0)
+        untagged = 1 - np.bincount(rows, weights=fractions, minlength=self.size)
+        untagged_rows = np.nonzero(untagged > 1e-9)[0]
+        return (np.concatenate((rows, untagged_rows)), np.concatenate((codes + 1, np.zeros(len(untagged_rows), int))),
+                np.concatenate((fractions, untagged[untagged_rows])))
+
+
+def format_date(date):
     """
-    Get details of the current semester and week, and calculate workloads.
-    :return: list of various values
+    Convert a date string given by the Toggl API into UNIX seconds.
+    :param date: string, e.g. '2018-09-01T09:00:00+00:00'
+    :return: UNIX seconds
     """
-    progress = int(current_time().strftime('%s')) - int(GLOBAL_START_DATE.strftime('%s'))
-    if progress <= 0:
-        print("Year hasn't started yet. Try after " + GLOBAL_START_DATE.strftime('%Y-%m-%d %H:%M:%S'))
-        sys.exit(0)
+    return int(datetime.fromisoformat(date).timestamp())
 
-    n_weeks = int(np.floor(progress / (7 * 24 * 60 * 60)))  # Current week number -1
 
-    if n_weeks + 1 > len(semester_data):
-        print("Year has ended. Use the time machine to access previous dates.")
-        sys.exit(0)
+class Account:
+    """
+    A Toggl account: its config, its connection to Toggl and the local copy of its time entries.
+    """
 
-    current_week_date = GLOBAL_START_DATE + timedelta(weeks=n_weeks)  # Date of start of this week
+    def __init__(self, config, session=None):
+        """
+        :param config: Config
+        :param session: requests.Session to share with other accounts, or None to make one when needed
+        """
+        self.config = config
+        self.name = os.path.splitext(os.path.basename(config.path))[0]  # Name of the config file
+        cache_file = CACHE_FILE if os.path.basename(config.path) == CONFIG_FILE else self.name + '_' + CACHE_FILE
+        self.cache_file = os.path.join(os.path.dirname(config.path), cache_file)
+        self.cache = None  # Local copy of the time entries; loaded from cache_file on the first query
+        self.table = None  # Time entries up to the current time, from cache
+        self.version = 0  # Changed every time query_toggl() or a pushed change brings new data
+        self.versions = itertools.count(1)  # Source of the versions; safe to take from in several threads
+        self.metrics = Metrics()  # Timings of the refreshes and the display
+        self._session = session
+        self._auth = None
+
+    @property
+    def session(self):
+        """
+        Connection to Toggl; kept alive between requests.
+        :return: requests.Session
+        """
+        if self._session is None:
+            self._session = make_session(FETCH_WORKERS)
+        return self._session
+
+    @property
+    def auth(self):
+        """
+        Credentials for Toggl, given with each request so a session can be shared between accounts.
+        :return: requests.auth.HTTPBasicAuth
+        """
+        if self._auth is None:
+            from requests.auth import HTTPBasicAuth
+            self._auth = HTTPBasicAuth(self.config.api_token, 'api_token')
+        return self._auth
+
+
+def make_session(pool_size=1):
+    """
+    Make a connection to Toggl that is kept alive between requests.
+    :param pool_size: number of connections to keep open at once
+    :return: requests.Session
+    """
+    import requests
+    session = requests.Session()
+    session.headers.update({'content-type': 'application/json'})
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
-    # Find when the semester starts
-    semester_starts = np.where(semester_data[:, 0] != '')[0]
-    semester_starts = int(max(semester_starts[semester_starts <= n_weeks]))
-    semester_start_date = GLOBAL_START_DATE + timedelta(weeks=semester_starts)
 
-    # Find when the semester ends
-    semester_ends = np.where(semester_data[:, 0] != '')[0]
-    try:
-        semester_ends = int(min(semester_ends[semester_ends > n_weeks]))
-    except ValueError:
-        semester_ends = len(semester_data)
-    semester_end_date = GLOBAL_START_DATE + timedelta(weeks=semester_ends)
+def request_entries(account, start_date, end_date):
+    """
+    Download the time entries started between two dates using the Toggl API.
+    The response is parsed one entry at a time as it arrives, and only the entries of tracked projects are kept.
+    :param account: Account
+    :param start_date: datetime object
+    :param end_date: datetime object
+    :return: EntryStore of time entries, number of entries Toggl sent, number of bytes downloaded, start datetime of
+    the last entry sent (or None)
+    """
+    parameters = {'start_date': start_date.isoformat(), 'end_date': end_date.isoformat()}
+    url = API_URL + '/time_entries'
+    if len(parameters) > 0:
+        url = url + '?{}'.format(urlencode(parameters))
 
-    semester_name = semester_data[semester_starts][0]  # Name of semester
-    week = semester_data[n_weeks, 1]  # Name of week
+    metrics = account.metrics
+    start = time.perf_counter()
+    with account.session.get(url, auth=account.auth, timeout=REQUEST_TIMEOUT, stream=True) as r:
+        metrics.add('request', time.perf_counter() - start)  # Until the headers arrive
+        r.raise_for_status()  # Check if there was an error
+        download = [0, 0]  # Seconds waiting for the body, bytes
+        decoder = codecs.getincrementaldecoder('utf-8')()
+
+        def chunks():
+            content = r.iter_content(chunk_size=64 * 1024)
+            while True:
+                wait = time.perf_counter()
+                chunk = next(content, None)
+                download[0] += time.perf_counter() - wait
+                if chunk is None:
+                    return
+                download[1] += len(chunk)
+                yield decoder.decode(chunk)
+
+        def counted(entries):
+            for entry in entries:
+                n_entries[0] += 1
+                last_start[0] = entry.get('start')
+                yield entry
+
+        n_entries = [0]  # Including untracked projects
+        last_start = [None]  # Toggl sends the entries in order of start time
+        start = time.perf_counter()
+        table = process_entries(account.config, counted(iter_json_array(chunks())))
+        metrics.add('download', download[0])
+        metrics.add('parse', time.perf_counter() - start - download[0])  # Parsed while downloading
+        last_start = datetime.fromisoformat(last_start[0]) if last_start[0] is not None else None
+        return table, n_entries[0], download[1], last_start
+
+
+def request_window(account, start_date, end_date):
+    """
+    Download the time entries started between two dates, retrying each request on its own if it fails. If Toggl
+    sends TOGGL_PAGE_LIMIT entries the response may have been cut short, so the entries are requested again from the
+    start of the last one sent, a page at a time. Entries started at that same time are sent twice; fetch_windows()
+    drops the copies.
+    :param account: Account
+    :param start_date: datetime object
+    :param end_date: datetime object
+    :return: EntryStore of time entries, number of bytes downloaded
+    """
+    import requests
+    table = EntryStore()
+    total_bytes = 0
+    page_start = start_date
+    while True:
+        for attempt in range(FETCH_RETRIES):
+            try:
+                page, n_entries, n_bytes, last_start = request_entries(account, page_start, end_date)
+                break
+            except (requests.RequestException, ValueError) as e:
+                if attempt == FETCH_RETRIES - 1:
+                    raise
+                logging.warning('Retrying Toggl time entries from %s to %s. %s', page_start, end_date, e)
+                time.sleep(retry_after(e) or RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+        table.extend(page)
+        total_bytes += n_bytes
+        if n_entries < TOGGL_PAGE_LIMIT:
+            return table, total_bytes
+        if last_start is None or last_start <= page_start:  # A whole page started at the same time; can't move on
+            logging.warning('Toggl sent the most time entries it allows from %s to %s', page_start, end_date)
+            return table, total_bytes
+        page_start = last_start
+
+
+def month_windows(start_date, end_date):
+    """
+    Split the time between two dates at the start of each month (UTC).
+    :param start_date: datetime object
+    :param end_date: datetime object
+    :return: list of (start, end) datetime objects, in order
+    """
+    windows = []
+    while start_date < end_date:
+        next_month = start_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        if next_month.month == 12:
+            next_month = next_month.replace(year=next_month.year + 1, month=1)
+        else:
+            next_month = next_month.replace(month=next_month.month + 1)
+        windows.append((start_date, min(next_month, end_date)))
+        start_date = next_month
+    return windows
 
-    # Fractional workload for week in semester
-    modules = project_data[:, 0:3]  # Name, pid, semester
-    workloads = np.array(semester_data[:, 3], dtype=str)
-    for week_row in workloads:
-        cases = week_row.split(';')
-        default = cases[0]
-        week_row = np.full(len(modules), default, dtype=float)
-        if len(cases) > 1:  # If custom values are specified
-            for case in np.array(cases[1:]):
-                case = case.split(':')
-                week_row[np.where(modules[:, 1] == case[0])[0]] = case[1]
-        try:
-            workload_table = np.vstack([workload_table, week_row])
-        except NameError:
-            workload_table = week_row
-        logging.info(week_row)
 
-    semester_total_workload = np.array(workload_table[semester_starts:semester_ends+1], dtype=float).sum(axis=0)
-    semester_so_far_workload = np.array(workload_table[semester_starts:n_weeks+1], dtype=float).sum(axis=0)
-    week_workload = np.array(workload_table[n_weeks], dtype=float)
+def fetch_windows(account, windows):
+    """
+    Download the time entries of several windows, FETCH_WORKERS at a time over the account's session.
+    :param account: Account
+    :param windows: list of (start, end) datetime objects, in order
+    :return: EntryStore of the time entries of all the windows, sorted and without duplicates
+    """
+    if len(windows) <= 1:  # Usual refresh; no threads needed
+        results = [request_window(account, *window) for window in windows]
+    else:
+        with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(windows))) as executor:
+            results = list(executor.map(lambda window: request_window(account, *window), windows))
+    table = EntryStore()
+    for fetched, n_bytes in results:  # In order of the windows
+        table.extend(fetched)
+    table.sort()
+    ids, first = np.unique(table.id, return_index=True)
+    if len(ids) < len(table):  # Entries starting on the edge of two windows are sent for both
+        table = table.take(np.sort(first))
+    account.metrics.count('bytes', sum(n_bytes for fetched, n_bytes in results))
+    account.metrics.count('fetched', len(table))
+    return table
+
 
-    workload = week_workload / semester_total_workload  # Workload for current week
-    cum_workload = semester_so_far_workload / semester_total_workload  # Cumulative workload for semester
+def request_current(account):
+    """
+    Get the running time entry using the Toggl API. This is a small request, made often to see whether a sync is
+    needed.
+    :param account: Account
+    :return: dictionary of the running time entry, or None if no timer is running
+    """
+    with account.metrics.span('probe'):
+        with account.session.get(API_URL + '/time_entries/current', auth=account.auth, timeout=REQUEST_TIMEOUT) as r:
+            r.raise_for_status()  # Check if there was an error
+            return r.json().get('data')
 
-    return semester_name, semester_start_date, semester_end_date, week, current_week_date, workload, cum_workload
+
+def retry_after(error):
+    """
+    Find how long Toggl asked to wait before trying again, if it refused a request for being too frequent.
+    :param error: exception raised by a request
+    :return: seconds, or None if it wasn't a rate limit response
+    """
+    response = getattr(error, 'response', None)
+    if response is None or response.status_code != 429:
+        return None
+    try:
+        return max(float(response.headers.get('Retry-After', RETRY_DELAY)), 0)
+    except ValueError:  # Given as a date
+        return RETRY_DELAY
 
 
-# Save the values
-CURRENT_SEMESTER, START_DATE, END_DATE, CURRENT_WEEK, \
-    CURRENT_WEEK_START_DATE, CUR_WORKLOAD, CUM_WORKLOAD = current_semester_data()
-CURRENT_WEEK_END_DATE = CURRENT_WEEK_START_DATE + timedelta(weeks=1)
+def iter_json_array(chunks):
+    """
+    Parse a JSON array of objects incrementally, so the whole document is never held in memory.
+    :param chunks: iterable of strings that together make up the JSON document
+    :return: generator of the objects in the array
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False  # Whether the opening '[' has been read
+    for chunk in chunks:
+        buffer += chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':  # Skip to the next value
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Expected a JSON array from Toggl')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            if buffer[position] != '{':
+                raise ValueError('Expected a JSON object from Toggl')
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except ValueError:  # Incomplete object; wait for the next chunk
+                break
+            yield item
+        buffer = buffer[position:]
+    raise ValueError('Incomplete JSON array from Toggl')
 
 
-def choose_tag(data):
+def cache_meta(config):
     """
-    Choose the first tag in data that appears in tracked tags.
-    :param data: List of tags
-    :return: string or None
+    Make the sync watermarks of an empty local copy of the time entries.
+    :param config: Config
+    :return: dictionary
     """
-    for tag in data:
-        if tag in TRACKED_TAGS[:, 0]:
-            return tag
-    return None
+    return {'start_date': config.start_date.isoformat(), 'pids': list(config.project_index),
+            'tags': list(config.tag_index), 'watermark': None, 'full_sync': None, 'complete': []}
 
 
-def query_toggl():
+def load_cache(account):
+    """
+    Load the local copy of the time entries saved by a previous sync.
+    A cache from a different year or for different projects or tags (or a missing or corrupt cache) is ignored.
+    :param account: Account
+    :return: dictionary with the sync watermarks ('meta') and an EntryStore of the time entries ('table')
+    """
+    meta = cache_meta(account.config)
+    empty = {'meta': meta, 'table': EntryStore()}
+    try:
+        with np.load(account.cache_file, allow_pickle=False) as f:
+            cached_meta = json.loads(str(f['meta']))
+            table = EntryStore(capacity=0)
+            table._data = {name: f[name].astype(dtype) for name, dtype in EntryStore.columns}
+            table._tags = {name: f[name].astype(dtype) for name, dtype in EntryStore.tag_columns}
+            table.size = len(table._data['id'])
+            table.n_tags = len(table._tags['tag_row'])
+    except (OSError, ValueError, KeyError) as e:
+        logging.info('No usable local cache. %s', e)
+        return empty
+    if any(cached_meta.get(key) != meta[key] for key in ('start_date', 'pids', 'tags')):
+        logging.info('Local cache is for a different configuration; ignoring it')
+        return empty
+    cached_meta.setdefault('complete', [])  # Cache from before months were recorded
+    return {'meta': cached_meta, 'table': table}
+
+
+def save_cache(account):
+    """
+    Atomically write the local copy of the time entries to disk.
+    :param account: Account
+    :return: nothing
+    """
+    temp_file = account.cache_file + '.tmp'
+    with open(temp_file, 'wb') as f:
+        np.savez(f, meta=json.dumps(account.cache['meta']),
+                 **{name: getattr(account.cache['table'], name)
+                    for name, dtype in EntryStore.columns + EntryStore.tag_columns})
+    os.replace(temp_file, account.cache_file)  # Never leave a half written cache behind
+
+
+def sync_cache(account):
+    """
+    Bring the local copy of the time entries up to date with Toggl.
+    Only entries started since the last sync (less SYNC_OVERLAP, or since the start of a timer that was running) are
+    requested. Within the windows requested the entries returned replace the cached ones with the same id, and cached
+    entries that were not returned have been deleted (or moved to an untracked project). Every FULL_SYNC_INTERVAL the
+    whole year is reconciled a month at a time, except for the months already recorded as complete: those that ended
+    WINDOW_SETTLE before a full sync with no timer running.
+    :param account: Account
+    :return: boolean; whether any entries were added, edited or deleted
+    """
+    now = datetime.now(timezone.utc)  # Sync up to the real time, even in the time machine
+    meta = account.cache['meta']
+    table = account.cache['table']
+    start_date = account.config.start_date
+
+    full_sync = meta['watermark'] is None or meta['full_sync'] is None or \
+        now - datetime.fromisoformat(meta['full_sync']) >= FULL_SYNC_INTERVAL
+    if full_sync:
+        window_start = start_date
+    else:
+        window_start = datetime.fromisoformat(meta['watermark']) - SYNC_OVERLAP
+        running = table.start[table.stop == -1]  # A timer that was running may have been stopped or edited since
+        if len(running) > 0:
+            window_start = min(window_start, datetime.fromtimestamp(int(running.min()), timezone.utc))
+        window_start = max(window_start, start_date)
+
+    complete = {tuple(window) for window in meta['complete']}
+    windows = [(start, end) for start, end in month_windows(window_start, now)
+               if (start.isoformat(), end.isoformat()) not in complete]
+    fetched = fetch_windows(account, windows)
+
+    # Keep the entries from outside the windows that haven't been moved into them, and replace the rest
+    with account.metrics.span('merge'):
+        edges = np.array([date.timestamp() for window in windows for date in window])
+        outside = np.searchsorted(edges, table.start, side='right') % 2 == 0  # Between an end and the next start
+        keep = outside & ~np.isin(table.id, fetched.id)
+        merged = table.take(keep)
+        merged.extend(fetched)
+        merged.sort()
+        changed = not merged.equals(table)
+    account.cache['table'] = merged
+
+    meta['watermark'] = now.isoformat()
+    if full_sync:
+        meta['full_sync'] = now.isoformat()
+        running = merged.start[merged.stop == -1]
+        first_running = datetime.fromtimestamp(int(running.min()), timezone.utc) if len(running) > 0 else now
+        meta['complete'] += [(start.isoformat(), end.isoformat()) for start, end in windows
+                             if end <= min(now - WINDOW_SETTLE, first_running)]
+    logging.info('Synced %s entries in %s windows since %s (%s kept, full=%s, changed=%s)',
+                 len(fetched), len(windows), window_start, np.count_nonzero(keep), full_sync, changed)
+    return changed or full_sync
+
+
+def query_toggl(account):
     """
     Get and process the relevant data from Toggl using the Toggl API.
-    :return: numpy array of time entries
+    :param account: Account
+    :return: EntryStore of time entries; the same object as last time if nothing has changed
     """
-    parameters = {'start_date': GLOBAL_START_DATE.isoformat(), 'end_date': current_time().isoformat()}
-    url = 'https://api.track.toggl.com/api/v8/time_entries'
-    if len(parameters) > 0:
-        url = url + '?{}'.format(urlencode(parameters))
+    if account.cache is None:
+        account.cache = load_cache(account)
+    if not sync_cache(account) and account.table is not None:
+        return account.table  # Nothing new; the TimeCube stays valid
+
+    try:
+        with account.metrics.span('save'):
+            save_cache(account)
+    except OSError as e:  # The dashboard still works without a cache
+        logging.error('Could not save the local cache. %s', e)
+    return new_table(account)
+
+
+def new_table(account):
+    """
+    Take the time entries up to the current time from the local copy as a new version of the data.
+    :param account: Account
+    :return: EntryStore of time entries
+    """
+    account.version = next(account.versions)  # Syncs and pushed changes never share a version
+    table = account.cache['table']
+    account.table = table.take(slice(0, np.searchsorted(table.start, current_time(), side='right')))
+    account.table.version = account.version  # Leave out entries started after the time machine date
+    account.metrics.count('entries', len(account.table))
+    return account.table
+
 
-    headers = {'content-type': 'application/json'}
-    r = requests.get(url, headers=headers, auth=HTTPBasicAuth(API_TOKEN, 'api_token'))
-    r.raise_for_status()  # Check if there was an error
+def reconfigure(account, config):
+    """
+    Switch an account to an edited config.csv, keeping the time entries already downloaded: they are moved to the new
+    pid and tag codes. Only new projects or tags, or an earlier start date, need the whole year to be downloaded again.
+    :param account: Account
+    :param config: new Config
+    :return: (whether a TimeCube of the old config can't be reused, whether a full sync is needed)
+    """
+    old = account.config
+    account.config = config
+    if config.api_token != old.api_token:  # A different Toggl account; none of the entries are its
+        account._auth = None
+        account.cache = {'meta': cache_meta(config), 'table': EntryStore()}
+        return True, True
+    pid_map = np.array([config.project_index.get(int(pid), -1) for pid in old.project_data[:, 1]], dtype=np.int64)
+    tag_map = np.array([config.tag_index.get(tag, -1) for tag in old.tracked_tags[:, 0]], dtype=np.int64)
+    rebuild = not (np.array_equal(pid_map, np.arange(len(config.project_data))) and
+                   np.array_equal(tag_map, np.arange(len(config.tracked_tags))) and
+                   np.array_equal(config.calendar.days, old.calendar.days) and config.tag_split == old.tag_split and
+                   np.array_equal(config.tag_weights, old.tag_weights))  # Otherwise only names or workloads changed
+    full_sync = not (set(config.project_index) <= set(old.project_index) and
+                     set(config.tag_index) <= set(old.tag_index) and config.start_date >= old.start_date)
+    if account.cache is None:  # Nothing downloaded yet
+        return rebuild, False
+
+    meta = account.cache['meta']
+    account.cache['table'] = account.cache['table'].recode(pid_map, tag_map)
+    if rebuild:  # The table shown is in the old codes; take it from the local copy again when next needed
+        account.table = None
+    meta.update(start_date=config.start_date.isoformat(), pids=list(config.project_index),
+                tags=list(config.tag_index))
+    if full_sync:  # The entries of the new projects, tags or weeks have never been downloaded
+        meta.update(watermark=None, full_sync=None, complete=[])
+    try:
+        save_cache(account)
+    except OSError as e:  # The dashboard still works without a cache
+        logging.error('Could not save the local cache. %s', e)
+    return rebuild, full_sync
 
-    entries = r.json()
 
-    def format_date(date):  # Format the date in the format required by the Toggl API
-        date_format = '%Y-%m-%dT%H:%M:%S%z'
-        date = date[:-3]+date[-2:]
-        return datetime.strptime(date, date_format)
+def webhook_entry(payload):
+    """
+    Convert a time entry sent by a Toggl webhook (API v9) into the form the v8 API gives.
+    :param payload: time entry dictionary
+    :return: time entry dictionary
+    """
+    entry = dict(payload)
+    if 'pid' not in entry:
+        entry['pid'] = entry.get('project_id')
+    if entry.get('stop') is None:  # Still running
+        entry.pop('stop', None)
+    return entry
 
-    current_timer = 0
+
+def process_entries(config, entries):
+    """
+    Process the time entries from Toggl into a table of the entries for tracked projects.
+    :param config: Config
+    :param entries: iterable of time entry dictionaries
+    :return: EntryStore of time entries
+    """
+    table = EntryStore()
     for entry in entries:  # Go through each recorded entry
-        try:  # Get the pid and semester of the module; and get tags
-            module = np.where(project_data[:, 1].astype(int) == int(entry['pid']))[0]
-            if len(module) != 0:  # If the entry's pid is in the defined list
-                pid = int(entry['pid'])
-                semester = project_data[module[0]][2]
-            else:
-                continue
-        except KeyError:  # If the entry isn't part of a project
+        pid = config.project_index.get(entry.get('pid'))  # Get the pid code of the module
+        if pid is None:  # If the entry isn't part of a tracked project; skip before parsing any dates
             continue
 
-        try:  # try to get the main tag for the entry
-            tag = choose_tag(entry['tags'])  # Choose the first tracked tag
-        except KeyError:
-            tag = None  # No tags set
+        start = format_date(entry['start'])
+        tags = tag_codes(config, entry.get('tags'))  # Tracked tags of the entry
 
         try:  # Try to get the time it was stopped
             stop = format_date(entry['stop'])
-        except KeyError:
-            current_timer = np.array([pid, semester, format_date(entry['start']), -1, -1, tag], dtype=object)
+        except KeyError:  # Still running
+            table.append(int(entry['id']), start, -1, -1, pid, tags)
             continue
         if int(entry['duration']) >= 0:  # If the duration is positive it has stopped
             duration = int(entry['duration'])
-        else:
-            print("ERROR: Unexpected negative duration")  # Should not happen according to API docs.
-            sys.exit(1)
-
-        valid_entry = np.array([pid, semester, format_date(entry['start']), stop, duration, tag], dtype=object)
-        try:
-            table = np.append(table, [valid_entry], axis=0)
-        except NameError:
-            table = np.array([valid_entry])
-
-    try:  # Record the current timer
-        if current_timer == 0:
-            pass
-    except ValueError:
-        try:
-            table = np.append(table, [current_timer], axis=0)
-        except NameError:
-            table = np.array([current_timer])
+        else:  # Should not happen according to API docs.
+            raise ValueError('Unexpected negative duration for time entry {}'.format(entry['id']))
 
-    try:  # If no entries have been added make None
-        table
-    except NameError:
-        table = np.array([[None, None, None, None, None, None]])
+        table.append(int(entry['id']), start, stop, duration, pid, tags)
 
+    table.sort()  # Allow time ranges to be found by binary search
     return table
 
 
-def filter_semester(data, position=1):
+class TimeCube:
     """
-    Filter 'data' to only include time entries started in the current semester.
-    :param data: data produced by query_toggl()
-    :param position: position of the semester column (for flexibility)
-    :return: filtered data
+    Tracked seconds for each day of the year, project and tracked tag, with cumulative sums along the days, so the
+    totals for any range of days are the difference of two slices. Running timers are kept separately and counted up
+    to the current time whenever totals are asked for.
     """
-    match_current_semester = np.where(data[:, position] == CURRENT_SEMESTER)[0]
-    match_all_semesters = np.where(data[:, position] == "ALL")[0]
-    return data[list(set(np.append(match_current_semester, match_all_semesters)))]
 
-
-def filter_week(data):
-    """
-    Filter 'data' to only include time entries started in the current week.
-    :param data: data produced by query_toggl()
-    :return: filtered data
-    """
-    match_current_week_min = np.where(data[:, 2] >= CURRENT_WEEK_START_DATE)[0]
-    match_current_week_max = np.where(data[:, 2] <= CURRENT_WEEK_END_DATE)[0]
-    match_current_week = np.intersect1d(match_current_week_min, match_current_week_max)
-    return data[match_current_week]
-
-
-def filter_day(data):
+    def __init__(self, config, data):
+        """
+        :param config: Config
+        :param data: data from query_toggl()
+        """
+        self.config = config  # Config the totals are for
+        self.version = data.version
+        running = data.stop == -1
+        stopped = data.take(~running)
+        self.running = data.take(running)
+        self.running_days = config.calendar.day(self.running.start)  # Day each timer was started
+        self.running_tags = self.running.tag_matrix(config)
+
+        n_days = len(config.calendar.days) - 1
+        shape = (n_days, len(config.project_data), len(config.tracked_tags) + 1)  # Tag code + 1; 0 for no tag
+        rows, columns, fractions = stopped.tag_matrix(config)
+        days = config.calendar.day(stopped.start)[rows]
+        valid = (days >= 0) & (days < n_days)  # Started during the year
+        cells = np.ravel_multi_index((days[valid], stopped.pid[rows[valid]], columns[valid]), shape)
+        seconds = np.rint(np.bincount(cells, weights=stopped.duration[rows[valid]] * fractions[valid],
+                                      minlength=np.prod(shape))).astype(np.int64)
+        self.cumulative = np.zeros((n_days + 1,) + shape[1:], dtype=np.int64)  # Row n is the total before day n
+        np.cumsum(seconds.reshape(shape), axis=0, out=self.cumulative[1:])
+
+    def seconds(self, first_day, last_day):
+        """
+        Total the tracked seconds for the time entries started in a range of days.
+        :param first_day: first day of the range (0 for the first day of the year)
+        :param last_day: day after the last day of the range
+        :return: numpy array of seconds indexed by [pid code, tag code + 1]; column 0 is entries without a tracked tag
+        """
+        seconds = self.cumulative[last_day] - self.cumulative[first_day]
+        rows, columns, fractions = self.running_tags
+        timers = (self.running_days[rows] >= first_day) & (self.running_days[rows] < last_day)
+        rows, columns, fractions = rows[timers], columns[timers], fractions[timers]
+        np.add.at(seconds, (self.running.pid[rows], columns),
+                  np.rint((int(time.time()) - self.running.start[rows]) * fractions).astype(np.int64))  # Running
+        return seconds
+
+    def updated(self, config, removed, added, version):
+        """
+        Make a copy with some time entries taken out and others put in, changing only the cumulative sums they are in
+        rather than adding up the whole year again.
+        :param config: Config
+        :param removed: EntryStore of time entries to take out
+        :param added: EntryStore of time entries to put in
+        :param version: Account version of the new data
+        :return: TimeCube
+        """
+        cube = copy.copy(self)
+        cube.version = version
+        cube.cumulative = self.cumulative.copy()  # The display may be reading this one
+        n_days = len(config.calendar.days) - 1
+        for entries, sign in ((removed, -1), (added, 1)):
+            stopped = entries.take(entries.stop != -1)
+            rows, columns, fractions = stopped.tag_matrix(config)
+            days = config.calendar.day(stopped.start)[rows]
+            seconds = np.rint(stopped.duration[rows] * fractions).astype(np.int64)
+            for day, pid, column, cell in zip(days, stopped.pid[rows], columns, seconds):
+                if 0 <= day < n_days:  # Started during the year
+                    cube.cumulative[day + 1:, pid, column] += sign * cell
+        cube.running = self.running.take(~np.isin(self.running.id, removed.id))
+        cube.running.extend(added.take(added.stop == -1))
+        cube.running.sort()
+        cube.running_days = config.calendar.day(cube.running.start)
+        cube.running_tags = cube.running.tag_matrix(config)
+        return cube
+
+
+class ProjectTable:
     """
-    Filter 'data' to only include time entries started in the current day.
-    :param data: data produced by query_toggl()
-    :return: filtered data
+    Tracked time and targets for a group of projects, produced by group_projects(). Each attribute has one value
+    (or row) per project: pid (pid codes), names, total (seconds to spend on the project), duration (seconds tracked),
+    week_target and semester_target (seconds expected this week and so far this semester), window_target (seconds
+    expected in the range of days given to group_projects(), if any), tag_durations (seconds tracked with each tracked
+    tag) and tags (fraction of the duration with each tracked tag).
     """
 
-    # Day starts at 3 am and continues to 3 am of the following day
-    day_start = quantise_date(current_time())  # Enforce 3 AM rule
-    day_end = day_start + timedelta(days=1)
+    def __init__(self, config, pid, total, duration, week_target, semester_target, window_target, tag_durations):
+        self.pid = pid
+        self.names = config.project_data[pid, 0]
+        self.total = total
+        self.duration = duration
+        self.week_target = week_target
+        self.semester_target = semester_target
+        self.window_target = window_target
+        self.tag_durations = tag_durations
+        self.tags = np.divide(tag_durations, duration[:, None], out=np.zeros(tag_durations.shape),
+                              where=duration[:, None] != 0)
 
-    match_current_day_min = np.where(data[:, 2] >= day_start)[0]
-    match_current_day_max = np.where(data[:, 2] <= day_end)[0]
-    match_current_day = np.intersect1d(match_current_day_min, match_current_day_max)
+    def __len__(self):
+        return len(self.pid)
 
-    return data[match_current_day]
 
-
-def group_projects(data, all_year=False):
+def group_projects(config, semester, seconds, all_year=False, days=None):
     """
-    Merge the query_toggl() data for each project to determine duration, and weekly and semester targets.
-    :param data: data from query_toggl() (or its filters)
+    Merge the tracked seconds for each project to determine duration, and weekly and semester targets.
+    :param config: Config
+    :param semester: Semester
+    :param seconds: TimeCube.seconds() output
     :param all_year: boolean to determine if only all year modules are to be included
-    :return: modified list of current projects from config file with additional columns
+    :param days: (first day, day after the last day) to also find the targets for, or None
+    :return: ProjectTable of the current projects
     """
 
     if all_year:  # Just give year-long details for semester="ALL" modules
-        current_projects = project_data[project_data[:, 2] == "ALL"]
-        valid_projects = np.sort(np.where(project_data[:, 2] == "ALL")[0])
+        valid_projects = config.all_year_projects
     else:
-        current_projects = filter_semester(project_data, position=2)  # Data on the semester's projects
-        cur_sem = np.where(project_data[:, 2] == CURRENT_SEMESTER)[0]
-        all_sem = np.where(project_data[:, 2] == "ALL")[0]
-        valid_projects = np.sort(np.concatenate((cur_sem, all_sem), axis=None).T.flatten())
-    cur_workload_f = CUR_WORKLOAD[valid_projects]  # Filtered
-    cum_workload_f = CUM_WORKLOAD[valid_projects]  # Filtered
-
-    n_projects = len(current_projects)  # Number of current projects
-    n_tags = len(TRACKED_TAGS)  # Number of tracked tags
-    durations = np.empty(n_projects, dtype=int)  # Holder for completed seconds for each project
-    tags = np.empty((n_projects, n_tags), dtype=float)
-
-    for i in range(n_projects):  # For each project
-        pid = int(current_projects[i, 1])  # Get the project ID
-
-        # Durations
-        filtered_data = data[data[:, 0] == pid]  # Get time entries in "data" for this project
-        durations[i] = np.sum(filtered_data[:, 4])  # Sum and record
-
-        # Clean total hours and convert to seconds
-        if current_projects[i, 2] == "ALL" and not all_year:
-            # Number of hours to do THIS semester; assume work equally shared with each semester
-            total_hours = float(current_projects[i, 3]) / float(n_semesters)
-        else:
-            total_hours = float(current_projects[i, 3])
-        current_projects[i, 3] = int(total_hours * 60 * 60)  # Convert to whole seconds
+        valid_projects = semester.projects
 
-        # Tags
-        for j in range(n_tags):
-            matched_tags = np.where(filtered_data[:, 5] == TRACKED_TAGS[j, 0])[0]  # Locations of entries with tag
-            if durations[i] == 0:  # If no relevant entries found
-                tags[i, j] = 0
-            else:
-                tags[i, j] = np.sum(filtered_data[matched_tags][:, 4]) / durations[i]  # Fraction of tot. project dur.
+    # Clean total hours and convert to whole seconds
+    total_hours = config.project_data[valid_projects, 3].astype(float)
+    if not all_year:  # Number of hours to do THIS semester; assume work equally shared with each semester
+        total_hours[config.project_data[valid_projects, 2] == "ALL"] /= float(config.n_semesters)
+    total = (total_hours * 60 * 60).astype(int)
 
-    # Number of seconds expected this week
-    week_targets = current_projects[:, 3].astype(int) * cur_workload_f  # Ignore if all_year=True
+    seconds = seconds[valid_projects]
+    durations = seconds.sum(axis=1).astype(int)  # Completed seconds for each project
 
-    # Number of seconds expected so far this semester including all of current week
-    semester_targets = current_projects[:, 3].astype(int) * cum_workload_f  # Ignore if all_year=True
+    week_targets = total * semester.workload[valid_projects]  # Number of seconds expected this week
+    semester_targets = total * semester.cum_workload[valid_projects]  # Number of seconds expected so far this semester
+    window_targets = None
+    if days is not None:  # Number of seconds expected in the range of days
+        cum_day_workload = config.cum_day_workload
+        window_targets = total * (cum_day_workload[days[1]] - cum_day_workload[days[0]])[valid_projects]
 
-    for new_col in [durations, week_targets, semester_targets]:  # Add the new data to the existing data
-        current_projects = np.append(current_projects, new_col.reshape((current_projects.shape[0], 1)), 1)
-    current_projects = np.append(current_projects, tags, 1)  # Add the tags
-    return current_projects
+    return ProjectTable(config, valid_projects, total, durations, week_targets, semester_targets, window_targets,
+                        seconds[:, 1:])
 
 
 def get_stats(data, mode):  # Processes group_projects() output
     """
     Get key statistics (target and/or completion progress) for given the time range.
     :param data: group_projects() output
-    :param mode: time range: "day", "week", "semester" or "all"
+    :param mode: time range: "day", "week", "window", "semester" or "all"
     :return: target and completion progress, with overall figures
     """
 
@@ -348,23 +1146,113 @@ def get_stats(data, mode):  # Processes group_projects() output
 
     # Get values for mode
     if mode == "day":
-        target = data[:, 4].astype(float) / (data[:, 5].astype(float) / 7)  # done / daily target
-        target_overall = np.sum(data[:, 4].astype(float)) / np.sum(data[:, 5].astype(float) / 7)
+        target = data.duration / (data.week_target / 7)  # done / daily target
+        target_overall = np.sum(data.duration) / np.sum(data.week_target / 7)
     elif mode == "week":
-        target = data[:, 4].astype(float) / data[:, 5].astype(float)  # done / weekly target
-        target_overall = np.sum(data[:, 4].astype(float)) / np.sum(data[:, 5].astype(float))
+        target = data.duration / data.week_target  # done / weekly target
+        target_overall = np.sum(data.duration) / np.sum(data.week_target)
+    elif mode == "window":
+        target = data.duration / data.window_target  # done / target for the range of days
+        target_overall = np.sum(data.duration) / np.sum(data.window_target)
     elif mode == "semester":
-        completion = data[:, 4].astype(float) / data[:, 3].astype(float)  # done / project total seconds
-        completion_overall = np.sum(data[:, 4].astype(float)) / np.sum(data[:, 3].astype(float))
-        target = data[:, 4].astype(float) / data[:, 6].astype(float)  # done / semester target progress
-        target_overall = np.sum(data[:, 4].astype(float)) / np.sum(data[:, 6].astype(float))
+        completion = data.duration / data.total  # done / project total seconds
+        completion_overall = np.sum(data.duration) / np.sum(data.total)
+        target = data.duration / data.semester_target  # done / semester target progress
+        target_overall = np.sum(data.duration) / np.sum(data.semester_target)
     elif mode == "all":
-        completion = data[:, 4].astype(float) / data[:, 3].astype(float)  # done / project total seconds
-        completion_overall = np.sum(data[:, 4].astype(float)) / np.sum(data[:, 3].astype(float))
+        completion = data.duration / data.total  # done / project total seconds
+        completion_overall = np.sum(data.duration) / np.sum(data.total)
 
     return target, target_overall, completion, completion_overall
 
 
+HISTORY_COLUMNS = ['DATE', 'SEMESTER', 'WEEK', 'PROJECT_NAME', 'DAY_HOURS', 'DAY_TARGET', 'WEEK_HOURS', 'WEEK_TARGET',
+                   'SEMESTER_HOURS', 'SEMESTER_TARGET', 'SEMESTER_TOTAL', 'DAY_PROGRESS', 'WEEK_PROGRESS',
+                   'SEMESTER_PROGRESS', 'SEMESTER_COMPLETION', 'YEAR_COMPLETION']
+
+
+def history(config, cube, days):
+    """
+    Find the day, week and semester stats that the time machine would show at the end of each of the given days, in
+    one pass over the whole year.
+    :param config: Config
+    :param cube: TimeCube of the data for the academic year
+    :param days: numpy array of days (0 for the first day of the year)
+    :return: list of rows; one for each project and one for the total on each day (see HISTORY_COLUMNS)
+    """
+    daily = np.diff(cube.cumulative, axis=0).sum(axis=2).astype(float)  # Seconds for each (day, pid code)
+    timers = cube.running_days < len(daily)
+    np.add.at(daily, (cube.running_days[timers], cube.running.pid[timers]),
+              int(time.time()) - cube.running.start[timers])  # Running timers count up to now
+    cumulative = np.concatenate((np.zeros((1, daily.shape[1])), np.cumsum(daily, axis=0)))
+
+    week_starts = days // 7 * 7  # First day of each day's week
+    semester_starts = config.semester_starts[config.week_semesters[days // 7]] * 7  # First day of each semester
+    cum_day_workload = config.cum_day_workload
+
+    # Seconds to spend on each project in a semester and in the year
+    year_total = config.project_data[:, 3].astype(float) * 60 * 60
+    total = np.where(config.project_data[:, 2] == "ALL", year_total / config.n_semesters, year_total)
+
+    # Each indexed by [step, pid code]
+    hours = np.stack((daily[days],  # Day
+                      cumulative[days + 1] - cumulative[week_starts],  # Week so far
+                      cumulative[days + 1])) / 60 / 60  # Semester tables include all the time on their projects
+    week_workload = cum_day_workload[week_starts + 7] - cum_day_workload[week_starts]
+    targets = np.stack((week_workload / 7, week_workload,
+                        cum_day_workload[week_starts + 7] - cum_day_workload[semester_starts],
+                        np.ones(week_workload.shape))) * total / 60 / 60  # Day, week, semester, semester total
+
+    rows = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for step, day in enumerate(days):
+            semester_name = config.semester_data[semester_starts[step] // 7, 0]
+            week = config.semester_data[day // 7, 1]
+            date = datetime.fromtimestamp(config.calendar.days[day]).strftime('%Y-%m-%d')
+            projects = np.where((config.project_data[:, 2] == semester_name) | (config.project_data[:, 2] == "ALL"))[0]
+            for name, pid in [(config.project_data[code, 0], [code]) for code in projects] + [("TOTAL", projects)]:
+                done = hours[:, step, pid].sum(axis=1)
+                target = targets[:, step, pid].sum(axis=1)
+                all_year = np.all(config.project_data[pid, 2] == "ALL")
+                rows.append([date, semester_name, week, name,
+                             done[0], target[0], done[1], target[1], done[2], target[2], target[3],
+                             done[0] / target[0], done[1] / target[1], done[2] / target[2], done[2] / target[3],
+                             done[2] * 60 * 60 / year_total[pid].sum() if all_year else ''])
+    return rows
+
+
+def run_batch(account, first_date, last_date, step="daily", path=HISTORY_FILE):
+    """
+    Batch time machine: save the stats for the end of every day (or week) between two dates to a CSV file.
+    The time entries are synced once and the whole range is found in one pass.
+    :param account: Account
+    :param first_date: date string, YYYY-MM-DD
+    :param last_date: date string, YYYY-MM-DD
+    :param step: "daily" or "weekly"
+    :param path: CSV file to write
+    :return: number of days written
+    """
+    config = account.config
+    days = []
+    for date in (first_date, last_date):
+        date = datetime.strptime(date, '%Y-%m-%d')  # Midday is always within the 3 AM day of the same date
+        days.append(int(config.calendar.day(time.mktime((date.year, date.month, date.day, 12, 0, 0, 0, 0, -1)))))
+    if days[0] < 0 or days[1] >= len(config.calendar.days) - 1:
+        raise ValueError("Dates must be within the year in config.csv")
+    days = np.arange(days[0], min(days[1], config.calendar.day(current_time())) + 1)  # Up to today
+    if step == "weekly":  # Last day of each week, and the last day given
+        days = days[(days % 7 == 6) | (days == days.max(initial=-1))]
+    elif step != "daily":
+        raise ValueError("Step must be daily or weekly")
+
+    cube = TimeCube(config, query_toggl(account))
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HISTORY_COLUMNS)
+        writer.writerows(history(config, cube, days))
+    return len(days)
+
+
 def format_time(seconds):
     """
     Convert number of seconds to hh:mm
@@ -384,268 +1272,1168 @@ def format_time(seconds):
         return '{0:0>-2}'.format(whole_hours) + ':' + '{0:0>-2}'.format(whole_minutes)
 
 
-# Start UNIX, MacOS output
-stdscr = curses.initscr()
-y = 0  # Initialise line counter
+def char_width(char):
+    """
+    Find how many columns of the terminal a character takes up.
+    :param char: string of one character
+    :return: 0, 1 or 2
+    """
+    if unicodedata.combining(char):
+        return 0
+    return 2 if unicodedata.east_asian_width(char) in ('W', 'F') else 1
 
 
-def print_nl(string, bold=False):
+def clip_width(string, width):
     """
-    Print a new line to the terminal with curses
-    :param string: string to print
-    :param bold: activate bold formatting
-    :return: nothing
+    Cut a string to fit in a number of columns of the terminal, so curses doesn't wrap it on to the next line.
+    :param string: string
+    :param width: number of columns
+    :return: string
     """
-    global y, stdscr
-    try:  # Don't go over the bottom
-        if bold:  # Output bold text
-            stdscr.addstr(y, 0, string, curses.A_BOLD)
-        else:  # Output regular text
-            stdscr.addstr(y, 0, string)
-        y += 1  # Move cursor to next line
-    except curses.error:
-        height1, width1 = stdscr.getmaxyx()  # Update display size
-        stdscr.addstr(height1-1, 0, str('...'))  # Alert
+    if string.isascii():
+        return string[:width]
+    columns = 0
+    for n, char in enumerate(string):
+        columns += char_width(char)
+        if columns > width:
+            return string[:n]
+    return string
 
 
-def print_reset():
+class Screen:
     """
-    Reset the curses screen for a new loop.
-    :return: nothing
+    UNIX, MacOS output with curses. Lines are printed to a model of the screen which is then drawn by print_frame().
+    """
+
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        self.frame = []  # Lines of the screen being built; (string, bold) pairs
+        self.shown = []  # Lines currently on the screen
+        self.shown_size = None  # Display size when the lines currently on the screen were drawn
+        self.height, self.width = stdscr.getmaxyx()  # Display size
+
+    def print_nl(self, string, bold=False):
+        """
+        Print a new line to the screen being built. It is drawn by print_frame().
+        :param string: string to print
+        :param bold: activate bold formatting
+        :return: nothing
+        """
+        self.frame.append((string, bold))
+
+    def print_reset(self):
+        """
+        Start building a new screen for a new loop.
+        :return: nothing
+        """
+        self.height, self.width = self.stdscr.getmaxyx()  # Display size
+        self.frame = []  # Start printing at top of screen
+
+    def print_frame(self, status, footer=None):
+        """
+        Draw the screen built since print_reset() with curses. Only the lines (and the ends of lines) that differ from
+        the screen already shown are written, so the terminal is not cleared and redrawn every second.
+        :param status: string to show in the top left corner
+        :param footer: string to show on the bottom line, or None
+        :return: nothing
+        """
+        stdscr = self.stdscr
+        height = self.height - 1 if footer is not None else self.height  # Lines for the tables
+        lines = [(clip_width(string, self.width), bold) for string, bold in self.frame[:height]]  # Don't go over
+        if len(self.frame) > height and len(lines) > 0:  # Alert that tables have been cut
+            lines[-1] = ('...' + lines[-1][0][3:], lines[-1][1])
+        if len(lines) == 0:
+            lines = [('', False)]
+        lines[0] = (clip_width(status + lines[0][0][len(status):], self.width), lines[0][1])  # Status in the top left
+        if footer is not None:  # Pad to the bottom line
+            lines = lines + [('', False)] * (height - len(lines)) + [(clip_width(footer, self.width), False)]
+
+        if self.shown_size != (self.height, self.width):  # Resized; redraw everything
+            stdscr.clear()
+            self.shown = []
+            self.shown_size = (self.height, self.width)
+
+        overflow = False  # Whether the previous line written may have run on to this line
+        for row in range(max(len(lines), len(self.shown))):
+            string, bold = lines[row] if row < len(lines) else ('', False)
+            old_string, old_bold = self.shown[row] if row < len(self.shown) else ('', False)
+            if (string, bold) == (old_string, old_bold) and not overflow:
+                continue
+            start, end = 0, len(string)  # Characters that have changed
+            if bold == old_bold and not overflow:
+                while start < min(len(string), len(old_string)) and string[start] == old_string[start]:
+                    start += 1
+                if len(string) == len(old_string):
+                    while end > start and string[end - 1] == old_string[end - 1]:
+                        end -= 1
+                    if not (string[:end].isascii() and old_string[:end].isascii()):  # The end may have moved
+                        end = len(string)
+                if not string[:start].isascii():  # Wide characters before it; position unknown
+                    start = 0
+            try:
+                if end == len(string):  # Remove the end of the old line
+                    stdscr.move(row, start)
+                    stdscr.clrtoeol()
+                stdscr.addstr(row, start, string[start:end], curses.A_BOLD if bold else curses.A_NORMAL)
+            except curses.error:  # Writing to the bottom right corner moves the cursor off the screen
+                pass
+            overflow = not string[start:end].isascii()  # Wide characters can push the end on to the next line
+        stdscr.refresh()
+        self.shown = lines
+
+
+class Wakeup:
+    """
+    Wait for something that changes the screen: a key press, the terminal being resized, or a refresh that brings new
+    data (signalled through a pipe by the worker threads), so the display sleeps in between.
     """
-    global y, stdscr, height, width, loops
-    height, width = stdscr.getmaxyx()  # Display size
-    status = '!' if TOGGL_ERROR else str(loops + 1)  # Determine the refresh status message
-    stdscr.addstr(0, 0, status)
-    stdscr.refresh()  # Refresh screen
-    y = 0  # Start printing at top of screen
-    stdscr.clear()  # Clear previous screen
 
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        stdscr.nodelay(True)  # Read all the keys pressed without waiting
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+        signal.signal(signal.SIGWINCH, self.set)  # Terminal resized
+
+    def set(self, *args):
+        """
+        Wake the display. Safe to call from any thread and from a signal handler.
+        :return: nothing
+        """
+        try:
+            os.write(self.write_fd, b'.')
+        except BlockingIOError:  # Pipe full; already waking
+            pass
 
-def print_module_grid(data, heading, stat1=None, stat1_sum=None, stat2=None, stat2_sum=None, t="yearly"):
+    def wait(self, timeout):
+        """
+        Sleep until woken, a key is pressed or the time runs out.
+        :param timeout: most seconds to sleep for
+        :return: list of the keys pressed
+        """
+        readable, nothing, nothing = select.select([sys.stdin, self.read_fd], [], [], max(timeout, 0))
+        if self.read_fd in readable:
+            try:
+                while os.read(self.read_fd, 4096):
+                    pass
+            except BlockingIOError:  # Emptied
+                pass
+        try:
+            size = os.get_terminal_size(sys.__stdout__.fileno())
+            if curses.is_term_resized(size.lines, size.columns):
+                curses.resizeterm(size.lines, size.columns)
+        except OSError:
+            pass
+        keys = []
+        while True:
+            key = self.stdscr.getch()
+            if key == -1:
+                return keys
+            keys.append(key)
+
+
+@functools.lru_cache(maxsize=16)
+def module_layout(width, n_stats):
+    """
+    Compile the formats for a table of modules. Cached, so they are only rebuilt when the terminal is resized.
+    :param width: width of the terminal
+    :param n_stats: number of percentage columns
+    :return: maximum width of the names, heading format, body format
+    """
+    w = width - 22 - 9 * n_stats  # Maximum width
+    head_fmt = '{:>' + str(w) + '} {:^6} {:^6}' + ' {:^8}' * n_stats + ' {:^7}'  # Heading format
+    fmt = '{:>' + str(w) + '} {:>6} {:>6}' + ' {: 8.2%}' * n_stats + ' {:>7}'  # Body format
+    return w, head_fmt, fmt
+
+
+@functools.lru_cache(maxsize=16)
+def tag_layout(width, n_tags):
+    """
+    Compile the formats for the table of tags. Cached, so they are only rebuilt when the terminal is resized.
+    :param width: width of the terminal
+    :param n_tags: number of tracked tags
+    :return: maximum width of the names, heading format, body format
+    """
+    w = width - 8 * n_tags  # Maximum width
+    head_fmt = '{:>' + str(w) + '}' + ' {:^7}' * n_tags  # Heading format
+    fmt = '{:>' + str(w) + '}' + ' {: 7.2%}' * n_tags  # Body format
+    return w, head_fmt, fmt
+
+
+def grid_targets(data, t):
+    """
+    Choose the targets to show in a table of modules.
+    :param data: group_projects() output
+    :param t: type of target: "daily", "weekly", "window", "semester" or "yearly"
+    :return: numpy array of seconds for each module
+    """
+    if t == "daily":  # Use week target / 7
+        return data.week_target / 7
+    elif t == "weekly":
+        return data.week_target
+    elif t == "window":  # Range of days given to group_projects()
+        return data.window_target
+    elif t == "semester":
+        return data.semester_target
+    elif t == "yearly":  # Total seconds (hours) for module
+        return data.total
+
+
+def print_module_grid(screen, data, heading, stat1=None, stat1_sum=None, stat2=None, stat2_sum=None, t="yearly"):
     """
     Print a table of data for each module. Calculates more key numbers and formats the output.
-    :param data: list of module data
+    :param screen: Screen
+    :param data: group_projects() output
     :param heading: string for table heading
     :param stat1: list of decimals to be outputted as percentages
     :param stat1_sum: aggregate of stat1 list
     :param stat2: list of decimals to be outputted as percentages
     :param stat2_sum: aggregate of stat2 list
-    :param t: type of target to be outputted: "daily", "weekly", "semester" or "yearly"
+    :param t: type of target to be outputted: "daily", "weekly", "window", "semester" or "yearly"
     :return:
     """
-    total_duration = np.sum(data[:, 4].astype(float))  # Sum of durations
+    total_duration = np.sum(data.duration)  # Sum of durations
 
-    if t == "daily":  # Use week target / 7
-        targets = data[:, 5].astype(float) / 7
-    elif t == "weekly":
-        targets = data[:, 5].astype(float)
-    elif t == "semester":
-        targets = data[:, 6].astype(float)
-    elif t == "yearly":  # Total seconds (hours) for module
-        targets = data[:, 3].astype(float)
+    targets = grid_targets(data, t)
     total_targets = np.sum(targets)  # Sum of targets
 
-    remaining = targets - data[:, 4].astype(float)
+    remaining = targets - data.duration
     total_remaining = total_targets - total_duration
 
+    width = screen.width
     if width <= 40:  # Screen too narrow
-        print_nl('|<' + '-' * (width - 4) + '>|')
+        screen.print_nl('|<' + '-' * (width - 4) + '>|')
         return 0
 
-    if stat1 is not None and stat2 is not None:  # If two stats are given
-        w = width - 40  # Maximum width
-        head_fmt = '{0:>' + str(w) + '} {1:^6} {2:^6} {3:^8} {4:^8} {5:^7}'  # Heading format
-        fmt = '{0:>' + str(w) + '} {1:>6} {2:>6} {3: 8.2%} {4: 8.2%} {5:>7}'  # Body format
-        print_nl(head_fmt.format(heading[:w], '⏱', '🎯', '', '', '⏲'), bold=True)  # Print heading
-        print_nl('─' * width)  # Print rule
-        for module in range(len(data)):  # Print row for each module
-            print_nl(fmt.format(data[module, 0][:w], format_time(data[module, 4]), format_time(targets[module]),
-                     stat1[module], stat2[module], format_time(remaining[module])))
-        print_nl(fmt.format("TOTAL"[:w], format_time(total_duration), format_time(total_targets),
-                            stat1_sum, stat2_sum, format_time(total_remaining)), bold=True)  # Print aggregates
-    elif stat1 is not None:  # If one stat is given
-        w = width - 31  # Maximum width
-        head_fmt = '{0:>' + str(w) + '} {1:^6} {2:^6} {3:^8} {4:^7}'  # Heading format
-        fmt = '{0:>' + str(w) + '} {1:>6} {2:>6} {3: 8.2%} {4:>7}'  # Body format
-        print_nl(head_fmt.format(heading[:w], '⏱', '🎯', '', '⏲'), bold=True)  # Print heading
-        print_nl('─' * width)  # Print rule
-        for module in range(len(data)):  # Print row for each module
-            print_nl(fmt.format(data[module, 0][:w], format_time(data[module, 4]), format_time(targets[module]),
-                     stat1[module], format_time(remaining[module])))
-        print_nl(fmt.format("TOTAL"[:w], format_time(total_duration), format_time(total_targets),
-                            stat1_sum, format_time(total_remaining)), bold=True)  # Print aggregates
-    else:  # If no stats are given (Not currently in use.)
-        w = width - 22  # Maximum width
-        head_fmt = '{0:>' + str(w) + '} {1:^6} {2:^6} {3:^7}'  # Heading format
-        fmt = '{0:>' + str(w) + '} {1:>6} {2:>6} {3:>7}'  # Body format
-        print_nl(head_fmt.format(heading[:w], '⏱', '🎯', '⏲'), bold=True)  # Print heading
-        print_nl('─' * width)  # Print rule
-        for module in range(len(data)):  # Print row for each module
-            print_nl(fmt.format(data[module, 0][:w], format_time(data[module, 4]), format_time(targets[module]),
-                                format_time(remaining[module])))
-        print_nl(fmt.format("TOTAL"[:w], format_time(total_duration), format_time(total_targets),
-                            format_time(total_remaining)), bold=True)  # Print aggregates
-    print_nl('')  # Insert blank line between tables
-
-
-def print_tag_grid(data, toggl_data):
+    stats = [stat for stat in (stat1, stat2) if stat is not None]  # Percentage columns given
+    stat_sums = [stat_sum for stat, stat_sum in ((stat1, stat1_sum), (stat2, stat2_sum)) if stat is not None]
+    w, head_fmt, fmt = module_layout(width, len(stats))
+
+    screen.print_nl(head_fmt.format(heading[:w], '⏱', '🎯', *[''] * len(stats), '⏲'), bold=True)  # Print heading
+    screen.print_nl('─' * width)  # Print rule
+    for module in range(len(data)):  # Print row for each module
+        screen.print_nl(fmt.format(data.names[module][:w], format_time(data.duration[module]),
+                                   format_time(targets[module]), *[stat[module] for stat in stats],
+                                   format_time(remaining[module])))
+    screen.print_nl(fmt.format("TOTAL"[:w], format_time(total_duration), format_time(total_targets),
+                               *stat_sums, format_time(total_remaining)), bold=True)  # Print aggregates
+    screen.print_nl('')  # Insert blank line between tables
+
+
+def print_tag_grid(screen, config, data):
     """
     Print the table of tags for each project.
-    :param data: project data
-    :param toggl_data: query_toggl() data
+    :param screen: Screen
+    :param config: Config
+    :param data: group_projects() output
     :return: nothing
     """
 
     # Find tag proportions across all projects
-    total_duration = np.sum(data[:, 4].astype(float))  # Sum of durations
-    n_tags = len(TRACKED_TAGS)
-    tags = np.zeros(n_tags, dtype=float)
+    total_duration = np.sum(data.duration)  # Sum of durations
+    tags = np.zeros(len(config.tracked_tags), dtype=float)
     if total_duration == 0:  # If no relevant time entries found
         pass  # Keep all as zero
     else:
-        for i in range(n_tags):
-            matched_tags = np.where(toggl_data[:, 5] == TRACKED_TAGS[i, 0])[0]  # Locations of entries with tag
-            tags[i] = np.sum(toggl_data[matched_tags][:, 4]) / total_duration  # Fraction of total duration
+        tags = np.sum(data.tag_durations, axis=0) / total_duration  # Fraction of total duration
 
+    width = screen.width
     if width <= 40:  # Screen too narrow
-        print_nl('|<' + '-' * (width - 4) + '>|')
+        screen.print_nl('|<' + '-' * (width - 4) + '>|')
+        return 0
+
+    n_tags = min(len(config.tracked_tags), max((width - 20) // 8, 5))  # Leave off the tags that don't fit
+    if n_tags == 0:  # No tags tracked
         return 0
 
-    # Different formatting depending on number of tags tracked
-    if n_tags == 5:
-        w = width - 40  # Maximum width
-        head_fmt = '{0:>' + str(w) + '} {1:^7} {2:^7} {3:^7} {4:^7} {5:^7}'  # Heading format
-        fmt = '{0:>' + str(w) + '} {1: 7.2%} {2: 7.2%} {3: 7.2%} {4: 7.2%} {5: 7.2%}'  # Body format
-        print_nl(head_fmt.format("Tracked Tags"[:w], TRACKED_TAGS[0, 1], TRACKED_TAGS[1, 1], TRACKED_TAGS[2, 1],
-                                 TRACKED_TAGS[3, 1], TRACKED_TAGS[4, 1]), bold=True)  # Print heading
-        print_nl('─' * width)  # Print rule
-        for module in range(len(data)):  # Print row for each module
-            print_nl(fmt.format(data[module, 0][:w], float(data[module, 7]), float(data[module, 8]),
-                                float(data[module, 9]), float(data[module, 10]), float(data[module, 11])))
-        print_nl(fmt.format("ALL"[:w], tags[0], tags[1], tags[2], tags[3], tags[4]), bold=True)  # Print aggregates
-        print_nl('')
-    elif n_tags == 4:
-        w = width - 32  # Maximum width
-        head_fmt = '{0:>' + str(w) + '} {1:^7} {2:^7} {3:^7} {4:^7}'  # Heading format
-        fmt = '{0:>' + str(w) + '} {1: 7.2%} {2: 7.2%} {3: 7.2%} {4: 7.2%}'  # Body format
-        print_nl(head_fmt.format("Tracked Tags"[:w], TRACKED_TAGS[0, 1], TRACKED_TAGS[1, 1],
-                                 TRACKED_TAGS[2, 1], TRACKED_TAGS[3, 1]), bold=True)  # Print heading
-        print_nl('─' * width)  # Print rule
-        for module in range(len(data)):  # Print row for each module
-            print_nl(fmt.format(data[module, 0][:w], float(data[module, 7]), float(data[module, 8]),
-                                float(data[module, 9]), float(data[module, 10])))
-        print_nl(fmt.format("ALL"[:w], tags[0], tags[1], tags[2], tags[3]), bold=True)  # Print aggregates
-        print_nl('')
-    elif n_tags == 3:
-        w = width - 24  # Maximum width
-        head_fmt = '{0:>' + str(w) + '} {1:^7} {2:^7} {3:^7}'  # Heading format
-        fmt = '{0:>' + str(w) + '} {1: 7.2%} {2: 7.2%} {3: 7.2%}'  # Body format
-        print_nl(head_fmt.format("Tracked Tags"[:w], TRACKED_TAGS[0, 1], TRACKED_TAGS[1, 1],
-                                 TRACKED_TAGS[2, 1]), bold=True)  # Print heading
-        print_nl('─' * width)  # Print rule
-        for module in range(len(data)):  # Print row for each module
-            print_nl(fmt.format(data[module, 0][:w], float(data[module, 7]), float(data[module, 8]),
-                                float(data[module, 9])))
-        print_nl(fmt.format("ALL"[:w], tags[0], tags[1], tags[2]), bold=True)  # Print aggregates
-        print_nl('')
-    elif n_tags == 2:
-        w = width - 16  # Maximum width
-        head_fmt = '{0:>' + str(w) + '} {1:^7} {2:^7}'  # Heading format
-        fmt = '{0:>' + str(w) + '} {1: 7.2%} {2: 7.2%}'  # Body format
-        print_nl(head_fmt.format("Tracked Tags"[:w], TRACKED_TAGS[0, 1], TRACKED_TAGS[1, 1]), bold=True)  # Print heading
-        print_nl('─' * width)  # Print rule
-        for module in range(len(data)):  # Print row for each module
-            print_nl(fmt.format(data[module, 0][:w], float(data[module, 7]), float(data[module, 8])))
-        print_nl(fmt.format("ALL"[:w], tags[0], tags[1]), bold=True)  # Print aggregates
-        print_nl('')
-    elif n_tags == 1:
-        w = width - 8  # Maximum width
-        head_fmt = '{0:>' + str(w) + '} {1:^7}'  # Heading format
-        fmt = '{0:>' + str(w) + '} {1: 7.2%}'  # Body format
-        print_nl(head_fmt.format("Tracked Tags"[:w], TRACKED_TAGS[0, 1]), bold=True)  # Print heading
-        print_nl('─' * width)  # Print rule
-        for module in range(len(data)):  # Print row for each module
-            print_nl(fmt.format(data[module, 0][:w], float(data[module, 7])))
-        print_nl(fmt.format("ALL"[:w], tags[0]), bold=True)  # Print aggregates
-        print_nl('')
-
-
-def set_running(data):
-    """
-    Update current duration for any timers in query_toggl() data that are still running.
-    :param data: query_toggl() data
+    w, head_fmt, fmt = tag_layout(width, n_tags)
+    screen.print_nl(head_fmt.format("Tracked Tags"[:w], *config.tracked_tags[:n_tags, 1]), bold=True)  # Heading
+    screen.print_nl('─' * width)  # Print rule
+    for module in range(len(data)):  # Print row for each module
+        screen.print_nl(fmt.format(data.names[module][:w], *data.tags[module, :n_tags]))
+    screen.print_nl(fmt.format("ALL"[:w], *tags[:n_tags]), bold=True)  # Print aggregates
+    screen.print_nl('')
+
+
+class RefreshWorker(threading.Thread):
+    """
+    Refresh the Toggl data in the background so the display never waits for Toggl.
+    Every REFRESH_RATE seconds only the running time entry is asked for, and the time entries are synced when it has
+    changed (a timer was started, stopped or edited) or the data is MAX_STALENESS old. While no timer is running the
+    checks back off, doubling the wait after each one that finds nothing new, up to MAX_PROBE_INTERVAL.
+    Each sync is handed to the display as a TimeCube in 'snapshot'. Failed refreshes are retried after an
+    exponentially growing delay with random jitter, or after the wait Toggl asks for if it is limiting the requests.
+    config.csv is checked for edits every CONFIG_CHECK_INTERVAL seconds and reloaded without downloading the time
+    entries again; an edit that can't be read leaves the previous config in use.
+    """
+
+    def __init__(self, account, wakeup=None):
+        """
+        :param account: Account
+        :param wakeup: Wakeup to set when what is shown changes, or None
+        """
+        super().__init__(daemon=True)
+        self.account = account
+        self.wakeup = wakeup
+        self.poke = threading.Event()  # Set to refresh now
+        self.force = False  # Whether to sync at the next refresh even if the running timer hasn't changed
+        self.push = False  # Whether Toggl pushes changes with webhooks, so only MAX_STALENESS syncs are needed
+        self.lock = threading.Lock()  # Held while changing the local copy of the time entries or the snapshot
+        self.syncing = False  # Whether a sync is running; pushed changes may be overwritten by it
+        self.pending = []  # Pushed changes received during the sync, to apply again after it
+        self.snapshot = None  # Latest TimeCube; replaced in one assignment
+        self.refreshed = None  # time.time() of the last successful sync
+        self.current = None  # Running time entry at the last successful sync
+        self.next_refresh = time.time()  # time.time() of the next attempt
+        self.error = None  # Error from the last attempt, if it failed
+        self.failures = 0  # Number of attempts that have failed in a row
+        self.idle = 0  # Number of checks in a row that found nothing new with no timer running
+        self.config_stamp = self.stamp()  # (modification time, size) of the config.csv in use
+        self.config_error = None  # Error from reading config.csv after it was last edited, if it failed
+
+    def run(self):
+        while True:
+            if time.time() >= self.next_refresh:
+                self.refresh()
+            self.poke.wait(min(max(self.next_refresh - time.time(), 0), CONFIG_CHECK_INTERVAL))
+            self.poke.clear()
+            self.reload_config()
+
+    def stamp(self):
+        """
+        Find when config.csv was last edited.
+        :return: (modification time, size), or None if it can't be found
+        """
+        try:
+            stat = os.stat(self.account.config.path)
+        except OSError:  # Being replaced by an editor
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload_config(self):
+        """
+        Load config.csv again if it has been edited, rebuilding only what the edit changed. The time entries already
+        downloaded are kept, so Toggl is only asked for everything again if projects or tags were added or the year
+        starts earlier. If the edited config.csv can't be read the previous config stays in use and status() shows
+        the error until it is fixed.
+        :return: nothing
+        """
+        stamp = self.stamp()
+        if stamp is None or stamp == self.config_stamp:
+            return
+        self.config_stamp = stamp
+        path = self.account.config.path
+        shown = (self.snapshot, self.config_error)
+        try:
+            config = load_config(path)
+        except (ValueError, IndexError, KeyError, TypeError, AttributeError, OSError, UnicodeError) as e:
+            self.config_error = e
+            logging.error('Could not reload %s; keeping the previous config. %s', path, e)
+        else:
+            self.config_error = None
+            with self.lock:
+                rebuild, full_sync = reconfigure(self.account, config)
+                if self.snapshot is not None and rebuild:
+                    with self.account.metrics.span('cube'):
+                        self.snapshot = TimeCube(config, new_table(self.account))
+                elif self.snapshot is not None:  # Same codes and days; only the targets are worked out again
+                    self.snapshot = copy.copy(self.snapshot)
+                    self.snapshot.config = config
+            if full_sync:
+                self.refresh_now()
+            logging.info('Reloaded %s for %s (rebuilt=%s, full sync=%s)', path, self.account.name, rebuild, full_sync)
+        if self.wakeup is not None and (self.snapshot, self.config_error) != shown:
+            self.wakeup.set()
+
+    def refresh_now(self):
+        """
+        Sync the time entries without waiting for the next refresh.
+        :return: nothing
+        """
+        self.force = True
+        self.next_refresh = time.time()
+        self.poke.set()
+
+    def refresh(self):
+        """
+        Try to refresh the data once.
+        :return: number of seconds to wait before the next attempt
+        """
+        import requests
+        config = self.account.config
+        shown = (self.snapshot, self.error is None)
+        try:
+            current = request_current(self.account) if not self.push else self.current
+            changed = current != self.current
+            if self.snapshot is None or changed or self.force or time.time() - self.refreshed >= config.max_staleness:
+                self.syncing = True
+                try:
+                    with self.account.metrics.span('sync'):
+                        year_toggl_data = query_toggl(self.account)  # Data for academic year
+                    with self.lock:
+                        if self.snapshot is None or self.snapshot.version != year_toggl_data.version:
+                            with self.account.metrics.span('cube'):
+                                self.snapshot = TimeCube(config, year_toggl_data)
+                        pending = self.pending
+                finally:
+                    with self.lock:
+                        self.syncing = False
+                        self.pending = []
+                for entry, deleted in pending:  # Newer than the sync, or overwritten by it
+                    try:
+                        self.apply_event(entry, deleted)
+                    except (ValueError, KeyError, TypeError, AttributeError) as e:  # Never stop the refreshes
+                        logging.error('Could not apply a pushed change to time entry %s. %s', entry.get('id'), e)
+                self.refreshed = time.time()
+                self.current = current
+                self.force = False
+                logging.info('Refreshed Toggl time entries for %s', self.account.name)
+            self.error = None
+            self.failures = 0
+            self.idle = 0 if changed or current is not None else min(self.idle + 1, 16)
+            delay = min(config.refresh_rate * 2 ** self.idle, max(MAX_PROBE_INTERVAL, config.refresh_rate))
+            if self.push:  # Only reconcile
+                delay = config.max_staleness
+        except (requests.RequestException, ValueError) as e:  # HTTP or connection error encountered
+            self.error = e
+            self.failures += 1
+            delay = retry_after(e) or \
+                min(RETRY_DELAY * 2 ** (self.failures - 1), MAX_RETRY_DELAY) * random.uniform(0.5, 1.5)
+            logging.error('Could not refresh Toggl time entries for %s. %s', self.account.name, e)
+        self.account.metrics.dump(self.account.name)
+        self.next_refresh = time.time() + delay
+        if self.wakeup is not None and (self.snapshot, self.error is None) != shown:
+            self.wakeup.set()
+        return delay
+
+    def apply_event(self, entry, deleted=False):
+        """
+        Apply a change to one time entry pushed by Toggl to the local copy and the totals, without asking Toggl.
+        :param entry: time entry dictionary, in the form the v8 API gives
+        :param deleted: whether the time entry was deleted
+        :return: boolean; whether anything shown changed
+        """
+        with self.lock:
+            config = self.account.config  # May be reloaded until the lock is held
+            entry_id = int(entry['id'])
+            new = process_entries(config, [] if deleted else [entry])  # Raises before queueing a bad event
+            if self.syncing:
+                self.pending.append((entry, deleted))
+            if self.snapshot is None:  # Nothing to apply it to yet; the sync will include it
+                return False
+            table = self.account.cache['table']
+            old = table.id == entry_id
+            if not old.any() and len(new) == 0:  # Not a tracked project
+                return False
+            merged = table.take(~old)
+            merged.extend(new)
+            merged.sort()
+            self.account.cache['table'] = merged
+            data = new_table(self.account)
+            now = current_time()
+            removed = table.take(old & (table.start <= now))  # Only what was shown
+            self.snapshot = self.snapshot.updated(config, removed, new.take(new.start <= now), data.version)
+        logging.info('Applied a pushed change to time entry %s for %s', entry['id'], self.account.name)
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return True
+
+    def status(self):
+        """
+        Describe the state of the refreshes: nothing while they work, or '!' if the last refresh failed followed by
+        the age of the data in minutes. An edit to config.csv that can't be read is shown instead.
+        :return: string
+        """
+        if self.config_error is not None:
+            error = ' '.join(str(self.config_error).split())  # On one line
+            return '!{}: {}'.format(os.path.basename(self.account.config.path), error)
+        if self.error is None:
+            return ''
+        if self.refreshed is None:  # No data yet
+            return '!'
+        return '!' + str(int((time.time() - self.refreshed) // 60))
+
+    def next_status_change(self):
+        """
+        Find when status() will next change by itself.
+        :return: time.time() of the change, or infinity
+        """
+        if self.error is None or self.refreshed is None:
+            return float('inf')
+        return self.refreshed + 60 * ((time.time() - self.refreshed) // 60 + 1)
+
+
+class TeamWorker(threading.Thread):
+    """
+    Refresh the Toggl data of several accounts in the background, with at most SYNC_WORKERS syncing at once. Each
+    account has a RefreshWorker (not started as a thread of its own) that holds its data and retry state.
+    """
+
+    def __init__(self, accounts, wakeup=None):
+        """
+        :param accounts: list of Account
+        :param wakeup: Wakeup to set when what is shown changes, or None
+        """
+        super().__init__(daemon=True)
+        self.workers = [RefreshWorker(account, wakeup) for account in accounts]
+        self.pool = ThreadPoolExecutor(max_workers=max(min(SYNC_WORKERS, len(accounts)), 1))
+        self.poke = threading.Event()  # Set to refresh now
+
+    def run(self):
+        while True:
+            now = time.time()
+            due = [worker for worker in self.workers if worker.next_refresh <= now]
+            list(self.pool.map(RefreshWorker.refresh, due))  # Wait for all of them
+            self.poke.wait(min(max(min(worker.next_refresh for worker in self.workers) - time.time(), 0),
+                               CONFIG_CHECK_INTERVAL))
+            self.poke.clear()
+            for worker in self.workers:
+                worker.reload_config()
+
+    def refresh_now(self):
+        """
+        Sync the time entries of every account without waiting for the next refresh.
+        :return: nothing
+        """
+        for worker in self.workers:
+            worker.force = True
+            worker.next_refresh = time.time()
+        self.poke.set()
+
+    def next_status_change(self):
+        """
+        Find when status() will next change by itself.
+        :return: time.time() of the change, or infinity
+        """
+        return min(worker.next_status_change() for worker in self.workers)
+
+    def status(self):
+        """
+        Describe the state of the refreshes like RefreshWorker.status(), for the account that has been failing the
+        longest.
+        :return: string
+        """
+        for worker in self.workers:
+            if worker.config_error is not None:
+                return worker.status()
+        failing = [worker for worker in self.workers if worker.error is not None]
+        if failing:
+            return min(failing, key=lambda worker: worker.refreshed or 0).status()
+        return ''
+
+
+class TeamTable:
+    """
+    Tracked time and targets with one row per account, in the same form as ProjectTable so it can be printed with
+    print_module_grid(). Each account's row is the TOTAL row of its own tables.
+    """
+
+    def __init__(self, names, total, duration, week_target, semester_target):
+        self.names = names
+        self.total = total
+        self.duration = duration
+        self.week_target = week_target
+        self.semester_target = semester_target
+
+    def __len__(self):
+        return len(self.names)
+
+
+def build_team_sections(accounts, semesters, cubes, errors):
+    """
+    Work out the day, week and semester tables for a team, with a row for each account.
+    :param accounts: list of Account
+    :param semesters: Semester of each account
+    :param cubes: TimeCube of each account
+    :param errors: whether the last refresh of each account failed
+    :return: list of tables like build_sections()
+    """
+    names = np.array([account.name + (' !' if error else '') for account, error in zip(accounts, errors)],
+                     dtype=object)
+    totals = np.zeros((5, len(accounts)))  # Total, week target, semester target, and seconds this week and year
+    day_seconds = np.zeros(len(accounts))
+    for n, (semester, cube) in enumerate(zip(semesters, cubes)):
+        config = cube.config
+        day = int(config.calendar.day(current_time()))
+        week = int(config.calendar.day(semester.week_start))
+        year = cube.seconds(0, len(config.calendar.days) - 1)
+        projects = group_projects(config, semester, year)
+        totals[:, n] = (np.sum(projects.total), np.sum(projects.week_target), np.sum(projects.semester_target),
+                        np.sum(cube.seconds(week, week + 7)[semester.projects]), np.sum(projects.duration))
+        day_seconds[n] = np.sum(cube.seconds(day, day + 1)[semester.projects])
+
+    # Percentages for all the accounts at once
+    sections = []
+    for heading, duration, mode, t in (("Today", day_seconds, "day", "daily"),
+                                       ("This Week", totals[3], "week", "weekly"),
+                                       ("Semester", totals[4], "semester", "semester")):
+        team = TeamTable(names, totals[0], duration.astype(int), totals[1], totals[2])
+        target, target_overall, completion, completion_overall = get_stats(team, mode=mode)
+        sections.append(dict(data=team, heading=heading, stat1=target, stat1_sum=target_overall,
+                             stat2=completion, stat2_sum=completion_overall, t=t))
+    return sections
+
+
+def build_sections(config, semester, cube):
+    """
+    Work out all the tables.
+    :param config: Config
+    :param semester: Semester
+    :param cube: TimeCube of the data for the academic year
+    :return: list of tables in the order shown; dictionaries of the print_module_grid() arguments ('tags' is True
+    for the print_tag_grid() table)
+    """
+    day = int(config.calendar.day(current_time()))
+    week = int(config.calendar.day(semester.week_start))  # First day of the week
+    year = cube.seconds(0, len(config.calendar.days) - 1)  # Every day of the year
+    sections = []
+
+    # Day Section
+    projects = group_projects(config, semester, cube.seconds(day, day + 1))
+    target, target_overall, none1, none2 = get_stats(projects, mode="day")
+    heading = TIME_MACHINE_DATE.strftime('%a, %Y-%m-%d %H:%M:%S') if TIME_MACHINE_DATE is not None else "Today"
+    sections.append(dict(data=projects, heading=heading, stat1=target, stat1_sum=target_overall, t="daily"))
+
+    # Week Section
+    projects = group_projects(config, semester, cube.seconds(week, week + 7))
+    target, target_overall, none1, none2 = get_stats(projects, mode="week")
+    sections.append(dict(data=projects, heading=semester.week, stat1=target, stat1_sum=target_overall, t="weekly"))
+
+    # Rolling Sections
+    for n_days in config.rolling_days:
+        days = (max(day + 1 - n_days, 0), day + 1)  # Today and the days before it
+        projects = group_projects(config, semester, cube.seconds(*days), days=days)
+        target, target_overall, none1, none2 = get_stats(projects, mode="window")
+        sections.append(dict(data=projects, heading="Last {} Days".format(n_days),
+                             stat1=target, stat1_sum=target_overall, t="window"))
+
+    # Semester Section
+    projects = group_projects(config, semester, year)
+    target, target_overall, completion, completion_overall = get_stats(projects, mode="semester")
+    sections.append(dict(data=projects, heading=semester.name,
+                         stat1=target, stat1_sum=target_overall,
+                         stat2=completion, stat2_sum=completion_overall, t="semester"))
+
+    # Tracked Tags
+    sections.append(dict(data=projects, heading="Tracked Tags", tags=True))
+
+    # All Year Modules Section
+    all_year_projects = group_projects(config, semester, year, all_year=True)
+    if len(all_year_projects) > 0:  # Only show table if there are all year modules
+        none1, none2, completion, completion_overall = get_stats(all_year_projects, mode="all")
+        sections.append(dict(data=all_year_projects, heading="All Year Modules",
+                             stat1=completion, stat1_sum=completion_overall))
+
+    return sections
+
+
+def print_sections(screen, config, sections):
+    """
+    Print all the tables.
+    :param screen: Screen
+    :param config: Config
+    :param sections: build_sections() output
     :return: nothing
     """
-    for running in np.where(data[:, 3] == -1)[0]:  # Will only be one (Zero if TIME_MACHINE)
-        unix_start = int(data[running, 2].strftime('%s'))
-        unix_end = int(datetime.now(timezone.utc).strftime('%s'))
-        data[running, 4] = unix_end - unix_start  # Update duration
+    for section in sections:
+        if section.get('tags'):
+            print_tag_grid(screen, config, section['data'])
+        else:
+            print_module_grid(screen, **section)
 
 
-def main(stdscr):
-    global TOGGL_ERROR, loops
+def step_wait(values, speeds, rising=True):
+    """
+    Find how long until any of some fractions is shown differently as a percentage to 0.01%.
+    :param values: numpy array of fractions
+    :param speeds: numpy array of the most each fraction can change by per second (broadcast against values)
+    :param rising: whether the fractions only grow; otherwise they may also shrink
+    :return: seconds, or infinity
+    """
+    values, speeds = np.broadcast_arrays(np.asarray(values, dtype=float), np.asarray(speeds, dtype=float))
+    moving = np.isfinite(values) & (speeds > 0)
+    if not moving.any():
+        return float('inf')
+    values, speeds = values[moving], speeds[moving]
+    shown = np.round(values * 10000)  # In units of 0.01%
+    distance = (shown + 0.5) / 10000 - values  # To where it is next rounded up
+    if not rising:
+        distance = np.minimum(distance, values - (shown - 0.5) / 10000)
+    return float(np.min(np.maximum(distance, 0) / speeds))
+
+
+def minute_wait(values, speeds):
+    """
+    Find how long until any of some numbers of seconds is shown differently as hours and minutes by format_time().
+    :param values: numpy array of seconds
+    :param speeds: numpy array of how many seconds each grows by per second; negative if it shrinks
+    :return: seconds, or infinity
+    """
+    values, speeds = np.broadcast_arrays(np.asarray(values, dtype=float), np.asarray(speeds, dtype=float))
+    moving = np.isfinite(values) & (speeds != 0)
+    if not moving.any():
+        return float('inf')
+    values, speeds = values[moving], speeds[moving]
+    distance = np.where(speeds > 0, 60 * (np.floor(values / 60) + 1) - values,  # To the next whole minute
+                        values - 60 * (np.ceil(values / 60) - 1))
+    distance[distance >= 60] = 1  # On a whole minute, which format_time() may round down until the next second
+    return float(np.min(distance / np.abs(speeds)))
+
+
+def display_wait(sections, rates):
+    """
+    Find how long until a time or percentage in the tables changes as running timers add to the tracked time. Each
+    timer adds a second a second to the time of its row and of the TOTAL row, and takes it from their remaining time.
+    A percentage of a target grows by (timers counted in it) / (target) each second, and a tag's share of a row's time
+    changes by at most (timers counted in the row) / (row's time).
+    :param sections: build_sections() or build_team_sections() output
+    :param rates: function giving the number of running timers counted in each row of a table's data
+    :return: seconds, or infinity
+    """
+    waits = [float('inf')]
+    for section in sections:
+        data = section['data']
+        rate = np.asarray(rates(data), dtype=float)
+        if not rate.any():
+            continue
+        duration = np.append(data.duration, np.sum(data.duration)).astype(float)  # Rows and the TOTAL row
+        rate = np.append(rate, np.sum(rate))
+        if section.get('tags'):
+            total_tags = np.sum(data.tag_durations, axis=0) / duration[-1] if duration[-1] != 0 else \
+                np.zeros(data.tag_durations.shape[1])
+            speeds = np.divide(rate, duration, out=np.full(len(rate), np.inf), where=duration != 0)
+            waits.append(step_wait(np.vstack((data.tags, total_tags)), speeds[:, None], rising=False))
+            continue
+        targets = grid_targets(data, section.get('t', 'yearly'))
+        remaining = np.append(targets - data.duration, np.sum(targets) - duration[-1])
+        waits.append(minute_wait(np.concatenate((duration, remaining)), np.concatenate((rate, -rate))))
+        for stat, stat_sum in (('stat1', 'stat1_sum'), ('stat2', 'stat2_sum')):
+            if section.get(stat) is not None:
+                values = np.append(section[stat], section[stat_sum])  # Duration / target
+                speeds = np.divide(rate * values, duration, out=np.full(len(rate), np.inf), where=duration != 0)
+                waits.append(step_wait(values, speeds))
+    return min(waits)
+
+
+def next_change(config, semester, cube, sections=()):
+    """
+    Find when the tables will next change by themselves: when running timers change a time (to the minute) or a
+    percentage (to 0.01%), or the next day or week starts.
+    :param config: Config
+    :param semester: Semester
+    :param cube: TimeCube of the data for the academic year
+    :param sections: build_sections() output shown, to find when its times and percentages change
+    :return: time.time() of the change
+    """
+    now = current_time()
+    day = int(config.calendar.day(now))
+    wait = min([semester.week_end] + list(config.calendar.days[day + 1:day + 2])) - now
+    change = time.time() + max(wait, 0)
+    if len(cube.running) > 0:
+        timers = np.bincount(cube.running.pid, minlength=len(config.project_data))
+        wait = display_wait(sections, lambda data: timers[data.pid])
+        if wait < float('inf'):  # The tracked seconds only grow when a whole second of time.time() passes
+            change = min(change, np.floor(time.time()) + max(np.ceil(wait), 1) + 0.01)
+    return change
+
+
+def run(stdscr, account, semester, show_metrics=False, webhook_port=None):
+    """
+    Show the tables in the terminal, drawing them again only when they can have changed: when new data arrives, a
+    running timer changes a time or percentage shown, a new day or week starts, or the terminal is resized. Moves on
+    to the next week when it starts. Press 'r' to refresh the data now and 'q' to quit.
+    :param stdscr: curses window
+    :param account: Account
+    :param semester: Semester at launch
+    :param show_metrics: whether to show the timings on the bottom line
+    :param webhook_port: port to receive Toggl webhook events on, or None
+    :return: nothing
+    """
+    metrics = account.metrics
+    screen = Screen(stdscr)
+    wakeup = Wakeup(stdscr)
+    worker = RefreshWorker(account, wakeup)
+    if webhook_port is not None:
+        receive_webhooks(worker, webhook_port)
+    worker.start()
+    quit_time = time.time() + 60 * 60 if TIME_MACHINE_DATE is not None else None  # Quit the time machine after 1 h
     while True:
-        print_reset()  # Start printing from the top of the screen
-        if loops <= 0:
+        screen.print_reset()  # Start printing from the top of the screen
+        wake = worker.next_status_change()
+
+        cube = worker.snapshot
+        config = cube.config if cube is not None else account.config  # The totals and targets must match
+        if semester is None or semester.config is not config or current_time() >= semester.week_end:  # New week
             try:
-                year_toggl_data = query_toggl()  # Data for academic year
-                TOGGL_ERROR = False
-                logging.info('Refreshed Toggl time entries')
-            except (requests.HTTPError, requests.ConnectionError) as e:  # HTTP or connection error encountered
-                TOGGL_ERROR = True
-                logging.error('Could not refresh Toggl time entries. %s', e)
-                try:  # Check if previous local data exists
-                    year_toggl_data
-                except NameError:  # No previous data; keep trying Toggl
-                    continue  # Restart while loop
-                pass  # Use old data; try updating again later
-            finally:
-                loops = REFRESH_RATE  # Reset the refresh countdown
-
-        # Main output goes here
-
-        # Update duration for running timers
-        set_running(year_toggl_data)
-
-        # Filter time ranges
-        semester_toggl_data = filter_semester(year_toggl_data)  # Data for semester
-        week_toggl_data = filter_week(semester_toggl_data)  # Data for week
-        day_toggl_data = filter_day(week_toggl_data)  # Data for day
-
-        # Day Section
-        projects = group_projects(day_toggl_data)
-        target, target_overall, none1, none2 = get_stats(projects, mode="day")
-        print_module_grid(projects, TIME_MACHINE_DATE_STR if TIME_MACHINE else "Today", stat1=target, stat1_sum=target_overall, t="daily")
-
-        # Week Section
-        projects = group_projects(week_toggl_data)
-        target, target_overall, none1, none2 = get_stats(projects, mode="week")
-        print_module_grid(projects, CURRENT_WEEK, stat1=target, stat1_sum=target_overall, t="weekly")
-
-        # Semester Section
-        projects = group_projects(semester_toggl_data)
-        target, target_overall, completion, completion_overall = get_stats(projects, mode="semester")
-        print_module_grid(projects, CURRENT_SEMESTER,
-                          stat1=target, stat1_sum=target_overall,
-                          stat2=completion, stat2_sum=completion_overall, t="semester")
-
-        # Tracked Tags
-        print_tag_grid(projects, semester_toggl_data)
-
-        # All Year Modules Section
-        all_year_projects = group_projects(year_toggl_data, all_year=True)
-        if len(all_year_projects) > 0:  # Only show table if there are all year modules
-            none1, none2, completion, completion_overall = get_stats(all_year_projects, mode="all")
-            print_module_grid(all_year_projects, "All Year Modules", stat1=completion, stat1_sum=completion_overall)
-
-        if TIME_MACHINE:  # Freeze screen
-            print_reset()
-            time.sleep(60 * 60)  # Quit after 1 hour
-            sys.exit(0)
-
-        loops -= 1  # Count down to refresh
-        time.sleep(1)  # Update counter every 1 s
-
-
-curses.wrapper(main)
+                semester = current_semester_data(config)
+            except ValueError as e:  # Year has ended
+                semester = None
+                screen.print_nl(str(e))
+                screen.print_frame(worker.status())
+
+        if semester is None:
+            pass
+        elif cube is None:  # No data yet; keep waiting for Toggl
+            screen.print_frame(worker.status())
+        else:
+            # Main output goes here
+            with metrics.span('sections'):
+                sections = build_sections(config, semester, cube)
+            with metrics.span('draw'):
+                print_sections(screen, config, sections)
+                screen.print_frame(worker.status(), metrics.status() if show_metrics else None)  # Draw the changes
+            wake = min(wake, next_change(config, semester, cube, sections))
+
+        if quit_time is not None:  # Time machine; the tables are frozen
+            if time.time() >= quit_time:
+                return
+            wake = quit_time
+        keys = wakeup.wait(min(wake - time.time(), 60 * 60))
+        if ord('q') in keys:
+            return
+        if ord('r') in keys:
+            worker.refresh_now()
+
+
+def json_number(value):
+    """
+    Convert a number for JSON, which has no NaN or infinity.
+    :param value: number
+    :return: float, or None if it isn't finite
+    """
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def sections_json(config, sections):
+    """
+    Convert the tables from build_sections() to the structure served by the stats server. Times are in seconds and
+    percentages are fractions.
+    :param config: Config
+    :param sections: build_sections() output
+    :return: list of dictionaries
+    """
+    tables = []
+    for section in sections:
+        data = section['data']
+        if section.get('tags'):
+            total_duration = np.sum(data.duration)
+            tags = np.sum(data.tag_durations, axis=0) / total_duration if total_duration != 0 else \
+                np.zeros(len(config.tracked_tags))
+            tables.append({
+                'heading': section['heading'], 'type': 'tags', 'tags': list(config.tracked_tags[:, 1]),
+                'rows': [{'name': data.names[module], 'fractions': [json_number(tag) for tag in data.tags[module]]}
+                         for module in range(len(data))],
+                'total': {'name': 'ALL', 'fractions': [json_number(tag) for tag in tags]}})
+            continue
+        targets = grid_targets(data, section.get('t', 'yearly'))
+        stats = [section[stat] for stat in ('stat1', 'stat2') if section.get(stat) is not None]
+        stat_sums = [section[stat + '_sum'] for stat in ('stat1', 'stat2') if section.get(stat) is not None]
+        tables.append({
+            'heading': section['heading'], 'type': 'modules', 'target': section.get('t', 'yearly'),
+            'rows': [{'name': data.names[module], 'duration': int(data.duration[module]),
+                      'target': json_number(targets[module]), 'stats': [json_number(stat[module]) for stat in stats],
+                      'remaining': json_number(targets[module] - data.duration[module])}
+                     for module in range(len(data))],
+            'total': {'name': 'TOTAL', 'duration': int(np.sum(data.duration)), 'target': json_number(np.sum(targets)),
+                      'stats': [json_number(stat_sum) for stat_sum in stat_sums],
+                      'remaining': json_number(np.sum(targets) - np.sum(data.duration))}})
+    return tables
+
+
+class StatsServer(ThreadingHTTPServer):
+    """
+    Local HTTP server for the tables as JSON. The tables are only worked out again when there is new data, a new day
+    or week, or (as the seconds tracked are given) a new second while a timer is running, and clients that send the
+    ETag they have get 304 Not Modified.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, account, semester):
+        super().__init__(address, StatsHandler)
+        self.account = account
+        self.semester = semester
+        self.worker = RefreshWorker(account)
+        self.cached = None  # (key, ETag, body) of the last response
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        """
+        Get the JSON of the current tables, working it out again only when it may have changed.
+        :return: (ETag, body bytes), or None if there is no data yet
+        :raise ValueError: if the year has ended
+        """
+        with self.lock:
+            cube = self.worker.snapshot
+            config = cube.config if cube is not None else self.account.config
+            if self.semester.config is not config or current_time() >= self.semester.week_end:  # New week or config
+                self.semester = current_semester_data(config)
+            if cube is None:
+                return None
+            now = current_time()  # Seconds are shown, so the tables change every second while a timer is running
+            key = (cube.version, config, self.semester.week_start, int(config.calendar.day(now)),
+                   now if len(cube.running) > 0 else None)
+            if self.cached is None or self.cached[0] != key:
+                body = json.dumps({
+                    'semester': self.semester.name, 'week': self.semester.week, 'time': now,
+                    'sections': sections_json(config, build_sections(config, self.semester, cube))
+                }).encode('utf-8')
+                self.cached = (key, '"' + hashlib.sha1(body).hexdigest() + '"', body)
+            return self.cached[1:]
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    """
+    Serve StatsServer.snapshot() at / (or /stats), and the timings at /metrics.
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body = json.dumps(self.server.account.metrics.summary()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path.split('?')[0] not in ('/', '/stats'):
+            self.send_error(404)
+            return
+        try:
+            snapshot = self.server.snapshot()
+        except ValueError as e:  # Year has ended
+            self.send_error(410, str(e))
+            return
+        if snapshot is None:  # No data yet
+            self.send_response(503)
+            self.send_header('Retry-After', '5')
+            self.end_headers()
+            return
+        etag, body = snapshot
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('Stats server: ' + format, *args)
+
+
+def serve_stats(account, port=STATS_PORT, webhook_port=None):
+    """
+    Run the stats server on this computer until interrupted.
+    :param account: Account
+    :param port: port to listen on
+    :param webhook_port: port to receive Toggl webhook events on, or None
+    :return: nothing
+    """
+    try:
+        semester = current_semester_data(account.config)
+    except ValueError as e:  # Outside of the year
+        print(e)
+        sys.exit(0)
+    server = StatsServer(('127.0.0.1', port), account, semester)
+    if webhook_port is not None:
+        receive_webhooks(server.worker, webhook_port)
+    server.worker.start()
+    print("Serving the tables as JSON at http://127.0.0.1:{}/".format(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    Local HTTP receiver for Toggl webhook events about time entries, applied straight to a RefreshWorker's data. If
+    WEBHOOK_SECRET is set in config.csv, events must be signed with it.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, worker):
+        super().__init__(address, WebhookHandler)
+        self.worker = worker
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Apply the time entry events POSTed to WebhookServer, and answer Toggl's validation requests.
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        secret = self.server.worker.account.config.webhook_secret  # Changes if config.csv is edited
+        if secret:
+            signature = 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(signature, self.headers.get('X-Webhook-Signature-256', '')):
+                self.send_error(401)
+                return
+        try:
+            event = json.loads(body)
+            if 'validation_code' in event:  # Toggl checking the URL works
+                self.reply(200, json.dumps({'validation_code': event['validation_code']}).encode())
+                return
+            metadata = event.get('metadata') or {}
+            if metadata.get('model') == 'time_entry' and isinstance(event.get('payload'), dict):
+                self.server.worker.apply_event(webhook_entry(event['payload']), metadata.get('action') == 'deleted')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:  # Not a time entry event
+            self.send_error(400, str(e))
+            return
+        self.reply(200, b'')
+
+    def reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('Webhook receiver: ' + format, *args)
+
+
+def receive_webhooks(worker, port=WEBHOOK_PORT):
+    """
+    Start receiving Toggl webhook events for a RefreshWorker's account in the background. The worker then stops
+    checking the running timer and only syncs every MAX_STALENESS to reconcile.
+    :param worker: RefreshWorker
+    :param port: port to listen on
+    :return: WebhookServer
+    """
+    server = WebhookServer(('127.0.0.1', port), worker)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    worker.push = True
+    return server
+
+
+def run_team(stdscr, accounts):
+    """
+    Show the day, week and semester totals of several accounts in the terminal, drawing them again only when they can
+    have changed, like run().
+    :param stdscr: curses window
+    :param accounts: list of Account
+    :return: nothing
+    """
+    screen = Screen(stdscr)
+    wakeup = Wakeup(stdscr)
+    worker = TeamWorker(accounts, wakeup)
+    worker.start()
+    semesters = [None] * len(accounts)
+    while True:
+        screen.print_reset()  # Start printing from the top of the screen
+        wake = worker.next_status_change()
+
+        # Each account has its own year, so each moves on to its next week separately
+        shown = []
+        for n, account in enumerate(accounts):
+            cube = worker.workers[n].snapshot
+            config = cube.config if cube is not None else account.config
+            if semesters[n] is None or semesters[n].config is not config or current_time() >= semesters[n].week_end:
+                try:
+                    semesters[n] = current_semester_data(config)
+                except ValueError:  # Outside of the account's year
+                    semesters[n] = None
+            if semesters[n] is not None and cube is not None:
+                shown.append((n, cube))
+
+        if shown:
+            sections = build_team_sections([accounts[n] for n, cube in shown], [semesters[n] for n, cube in shown],
+                                           [cube for n, cube in shown],
+                                           [worker.workers[n].error is not None for n, cube in shown])
+            for section in sections:
+                print_module_grid(screen, **section)
+            wake = min([wake] + [next_change(cube.config, semesters[n], cube) for n, cube in shown])
+            wait = display_wait(sections, lambda data: [len(cube.running) for n, cube in shown])
+            if wait < float('inf'):  # The tracked seconds only grow when a whole second of time.time() passes
+                wake = min(wake, np.floor(time.time()) + max(np.ceil(wait), 1) + 0.01)
+        screen.print_frame(worker.status())  # Draw the changes
+        keys = wakeup.wait(min(wake - time.time(), 60 * 60))  # Check for new years hourly
+        if ord('q') in keys:
+            return
+        if ord('r') in keys:
+            worker.refresh_now()
+
+
+def main(argv=None):
+    """
+    Run the program from the command line.
+    :param argv: list of arguments; defaults to sys.argv[1:]
+    :return: nothing
+    """
+    global TIME_MACHINE_DATE
+    argv = sys.argv[1:] if argv is None else argv
+    show_metrics = '-p' in argv  # Show the timings on the bottom line
+    argv = [arg for arg in argv if arg != '-p']
+    webhook_port = None  # Port to receive Toggl webhook events on
+    if '-w' in argv:
+        n = argv.index('-w')
+        given = n + 1 < len(argv) and argv[n + 1].isdigit()
+        webhook_port = int(argv[n + 1]) if given else WEBHOOK_PORT
+        del argv[n:n + 1 + given]
+
+    if len(argv) > 0:  # Parse time machine data from given arguments
+        if argv[0] == '-t':
+            try:  # Check that the date is valid
+                TIME_MACHINE_DATE = datetime.strptime(argv[1] + ' ' + argv[2], '%Y-%m-%d %H:%M:%S').astimezone()
+            except (ValueError, IndexError) as e:
+                print("Invalid Time Machine Date. Required format: YYYY-MM-DD HH:MM:SS")
+                sys.exit(1)
+
+    logging.basicConfig(filename='targets.log', level=logging.DEBUG)
+
+    if len(argv) > 0 and argv[0] == '-m':  # Team dashboard
+        if len(argv) < 2:
+            print("Usage: targets.py -m CONFIG.csv [CONFIG.csv ...]")
+            sys.exit(1)
+        session = make_session(min(SYNC_WORKERS, len(argv) - 1) * FETCH_WORKERS)  # Shared by all the accounts
+        curses.wrapper(run_team, [Account(load_config(path), session) for path in argv[1:]])
+        return
+
+    config = load_config()
+    if len(argv) > 0 and argv[0] == '-b':  # Batch time machine; no screen
+        if len(argv) < 3:
+            print("Usage: targets.py -b YYYY-MM-DD YYYY-MM-DD [daily|weekly] [FILE]")
+            sys.exit(1)
+        import requests
+        try:
+            n_days = run_batch(Account(config), *argv[1:5])
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        except requests.RequestException as e:  # Toggl unreachable or refusing, even after retrying
+            print("Could not get the time entries from Toggl: {}".format(e))
+            sys.exit(1)
+        print("Saved {} days to {}".format(n_days, argv[4] if len(argv) > 4 else HISTORY_FILE))
+        return
+    if len(argv) > 0 and argv[0] == '-s':  # Stats server; no screen
+        try:
+            port = int(argv[1]) if len(argv) > 1 else STATS_PORT
+        except ValueError:
+            print("Usage: targets.py -s [PORT]")
+            sys.exit(1)
+        serve_stats(Account(config), port, webhook_port)
+        return
+
+    try:
+        semester = current_semester_data(config)
+    except ValueError as e:  # Outside of the year
+        print(e)
+        sys.exit(0)
+
+    curses.wrapper(run, Account(config), semester, show_metrics, webhook_port)
+
+
+if __name__ == '__main__':
+    main()